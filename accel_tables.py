@@ -0,0 +1,141 @@
+from die_scanner import read_uleb
+
+DW_TAG_subprogram = 0x2e
+DW_IDX_compile_unit = 1
+DW_IDX_type_unit = 2
+DW_IDX_die_offset = 3
+
+# the forms .debug_names uses for its index attributes
+NAMES_FIXED_FORMS = {0x0b: 1, 0x11: 1, 0x05: 2, 0x12: 2, 0x06: 4, 0x13: 4, 0x07: 8, 0x14: 8, 0x20: 8, 0x19: 0}
+NAMES_ULEB_FORMS = (0x0f, 0x15)
+
+GDB_INDEX_FUNCTION = 3
+
+
+def load_accelerator_index(elffile):
+    # cu_offset -> sorted absolute offsets of its subprogram DIEs, [] if the CU
+    # has none and None if the CU has to be walked. CUs that are not in the
+    # result are walked as well. None if the binary has no usable table.
+    debug_names = elffile.get_section_by_name('.debug_names')
+    if debug_names is not None:
+        try:
+            return parse_debug_names(debug_names.data(), 'little' if elffile.little_endian else 'big')
+        except (ValueError, IndexError, KeyError):
+            pass
+    gdb_index = elffile.get_section_by_name('.gdb_index')
+    if gdb_index is not None:
+        try:
+            return parse_gdb_index(gdb_index.data())
+        except (ValueError, IndexError):
+            pass
+    return None
+
+
+def parse_debug_names(data, byteorder):
+    def read(pos, size):
+        return int.from_bytes(data[pos:pos + size], byteorder), pos + size
+
+    index = {}
+    pos = 0
+    while pos < len(data):
+        unit_length, pos = read(pos, 4)
+        offset_size = 4
+        if unit_length == 0xffffffff:
+            unit_length, pos = read(pos, 8)
+            offset_size = 8
+        unit_end = pos + unit_length
+        version, pos = read(pos, 2)
+        if version != 5:
+            raise ValueError("unsupported .debug_names version %d" % version)
+        pos += 2
+        counts = []
+        for _ in range(7):
+            count, pos = read(pos, 4)
+            counts.append(count)
+        cu_count, local_tu_count, foreign_tu_count, bucket_count, name_count, abbrev_size, augmentation_size = counts
+        pos += augmentation_size
+
+        cu_offsets = []
+        for _ in range(cu_count):
+            cu_offset, pos = read(pos, offset_size)
+            cu_offsets.append(cu_offset)
+            index.setdefault(cu_offset, set())
+        pos += local_tu_count * offset_size + foreign_tu_count * 8
+        pos += bucket_count * 4 + (name_count * 4 if bucket_count else 0)
+        pos += name_count * offset_size
+        entry_offsets = []
+        for _ in range(name_count):
+            entry_offset, pos = read(pos, offset_size)
+            entry_offsets.append(entry_offset)
+
+        abbrevs = {}
+        entry_pool = pos + abbrev_size
+        while True:
+            code, pos = read_uleb(data, pos)
+            if code == 0:
+                break
+            tag, pos = read_uleb(data, pos)
+            attributes = []
+            while True:
+                attribute, pos = read_uleb(data, pos)
+                form, pos = read_uleb(data, pos)
+                if attribute == 0 and form == 0:
+                    break
+                attributes.append((attribute, form))
+            abbrevs[code] = (tag, attributes)
+
+        for entry_offset in entry_offsets:
+            pos = entry_pool + entry_offset
+            while True:
+                code, pos = read_uleb(data, pos)
+                if code == 0:
+                    break
+                tag, attributes = abbrevs[code]
+                # the CU index may be left out if the unit lists a single CU
+                cu_index = 0 if cu_count == 1 else None
+                die_offset = None
+                type_unit = False
+                for attribute, form in attributes:
+                    if form in NAMES_FIXED_FORMS:
+                        value, pos = read(pos, NAMES_FIXED_FORMS[form])
+                    elif form in NAMES_ULEB_FORMS:
+                        value, pos = read_uleb(data, pos)
+                    else:
+                        raise ValueError("unsupported .debug_names form 0x%x" % form)
+                    if attribute == DW_IDX_compile_unit:
+                        cu_index = value
+                    elif attribute == DW_IDX_type_unit:
+                        type_unit = True
+                    elif attribute == DW_IDX_die_offset:
+                        die_offset = value
+                if tag == DW_TAG_subprogram and not type_unit and cu_index is not None and die_offset is not None:
+                    cu_offset = cu_offsets[cu_index]
+                    index[cu_offset].add(cu_offset + die_offset)
+        pos = unit_end
+
+    return {cu_offset: sorted(offsets) for cu_offset, offsets in index.items()}
+
+
+def parse_gdb_index(data):
+    # only tells which CUs define functions, not where their DIEs are
+    def read(pos, size):
+        return int.from_bytes(data[pos:pos + size], 'little')
+
+    version = read(0, 4)
+    if version < 7:
+        raise ValueError("unsupported .gdb_index version %d" % version)
+    cu_list, types_list, _, symbol_table, constant_pool = [read(pos, 4) for pos in range(4, 24, 4)]
+
+    cu_offsets = [read(pos, 8) for pos in range(cu_list, types_list, 16)]
+    with_functions = set()
+    for slot in range(symbol_table, constant_pool, 8):
+        name_offset, vector_offset = read(slot, 4), read(slot + 4, 4)
+        if name_offset == 0 and vector_offset == 0:
+            continue
+        vector = constant_pool + vector_offset
+        for i in range(read(vector, 4)):
+            value = read(vector + 4 + i * 4, 4)
+            if (value >> 28) & 7 == GDB_INDEX_FUNCTION:
+                with_functions.add(value & 0xffffff)
+
+    return {cu_offset: None if i in with_functions else [] for i, cu_offset in enumerate(cu_offsets)}
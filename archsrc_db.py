@@ -0,0 +1,148 @@
+import json
+import os
+import sqlite3
+from psycopg_pool import ConnectionPool
+
+# override with ARCHSRC_DSN or configure(), e.g. for a local test database
+DEFAULT_DSN = "dbname=archsrc user=rouser password='' host=kuria port=5432"
+
+# one binary, a prepared statement as it runs once per binary
+FUNCTIONS_QUERY = """SELECT f.name[1], f.srcabspath, f.srcline, f.vaddr
+               FROM binaries b JOIN binary_functions f on b.binary_id = f.binary_id
+               WHERE b.compileopt = '00000' and b.relpath = %s and f.srcabspath IS NOT NULL;"""
+
+# streamed through a server-side cursor for a whole batch of binaries
+FUNCTIONS_STREAM_QUERY = """SELECT b.relpath, f.name[1], f.srcabspath, f.srcline, f.vaddr
+               FROM binaries b JOIN binary_functions f on b.binary_id = f.binary_id
+               WHERE b.compileopt = '00000' and b.relpath = ANY(%s) and f.srcabspath IS NOT NULL;"""
+# rows per network round trip of the server-side cursor
+STREAM_ROWS = 20000
+
+PACKAGE_UNITS_QUERY = """SELECT b.pkg, b.abspath, f.srcabspath, count(*)
+               FROM binaries b JOIN binary_functions f on b.binary_id = f.binary_id
+               WHERE b.compileopt = '00000' and f.srcabspath like '/usr%%'
+               GROUP BY b.pkg, b.abspath, f.srcabspath
+               ORDER BY b.pkg LIMIT %s;"""
+
+# the same queries against a local SQLite snapshot, see archsrc_snapshot.py
+SNAPSHOT_FUNCTIONS_QUERY = """SELECT f.name, f.srcabspath, f.srcline, f.vaddr
+               FROM binaries b JOIN binary_functions f on b.binary_id = f.binary_id
+               WHERE b.compileopt = '00000' and b.relpath = ? and f.srcabspath IS NOT NULL;"""
+
+SNAPSHOT_FUNCTIONS_BATCH_QUERY = """SELECT b.relpath, f.name, f.srcabspath, f.srcline, f.vaddr
+               FROM binaries b JOIN binary_functions f on b.binary_id = f.binary_id
+               WHERE b.compileopt = '00000' and b.relpath IN (%s) and f.srcabspath IS NOT NULL;"""
+
+SNAPSHOT_PACKAGE_UNITS_QUERY = """SELECT b.pkg, b.abspath, f.srcabspath, count(*)
+               FROM binaries b JOIN binary_functions f on b.binary_id = f.binary_id
+               WHERE b.compileopt = '00000' and f.srcabspath like '/usr%'
+               GROUP BY b.pkg, b.abspath, f.srcabspath
+               ORDER BY b.pkg LIMIT ?;"""
+
+dsn = os.environ.get("ARCHSRC_DSN", DEFAULT_DSN)
+# read from this SQLite snapshot instead of the database if set
+snapshot = os.environ.get("ARCHSRC_SNAPSHOT") or None
+max_connections = 4
+_pool = None
+_pool_pid = None
+_snapshot_conn = None
+_snapshot_pid = None
+
+
+def configure(new_dsn=None, connections=None, new_snapshot=None):
+    global dsn, max_connections, snapshot
+    if new_dsn is not None:
+        dsn = new_dsn
+    if connections is not None:
+        max_connections = connections
+    if new_snapshot is not None:
+        snapshot = new_snapshot or None
+    close()
+
+
+def get_pool():
+    # one pool per process, connections must not be shared with forked workers
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = ConnectionPool(dsn, min_size=1, max_size=max_connections, open=True)
+        _pool_pid = os.getpid()
+    return _pool
+
+
+def get_snapshot():
+    global _snapshot_conn, _snapshot_pid
+    if _snapshot_conn is None or _snapshot_pid != os.getpid():
+        if not os.path.exists(snapshot):
+            raise FileNotFoundError("archsrc snapshot %s does not exist" % snapshot)
+        _snapshot_conn = sqlite3.connect("file:%s?mode=ro" % snapshot, uri=True)
+        _snapshot_pid = os.getpid()
+    return _snapshot_conn
+
+
+def close():
+    global _pool, _pool_pid, _snapshot_conn, _snapshot_pid
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.close()
+    _pool = None
+    _pool_pid = None
+    if _snapshot_conn is not None and _snapshot_pid == os.getpid():
+        _snapshot_conn.close()
+    _snapshot_conn = None
+    _snapshot_pid = None
+
+
+def fetch(query, params):
+    # prepare=True makes psycopg use a server-side prepared statement
+    with get_pool().connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(query, params, prepare=True)
+            return cur.fetchall()
+
+
+def fetch_snapshot(query, params):
+    return get_snapshot().execute(query, params).fetchall()
+
+
+def stream_functions(relpaths):
+    # yields (relpath, name, srcabspath, srcline, vaddr) of all binaries, rows
+    # without a source file are left out
+    if snapshot:
+        relpaths = list(relpaths)
+        # stay below SQLite's host parameter limit
+        for i in range(0, len(relpaths), 500):
+            chunk = relpaths[i:i + 500]
+            query = SNAPSHOT_FUNCTIONS_BATCH_QUERY % ", ".join("?" * len(chunk))
+            for relpath, names, srcabspath, srcline, vaddr in get_snapshot().execute(query, chunk):
+                # names are a text[] in the database and stored as JSON in the snapshot
+                yield relpath, json.loads(names)[0], srcabspath, srcline, vaddr
+        return
+    with get_pool().connection() as conn:
+        with conn.cursor(name="archsrc_functions") as cur:
+            cur.itersize = STREAM_ROWS
+            cur.execute(FUNCTIONS_STREAM_QUERY, (list(relpaths),))
+            yield from cur
+
+
+def fetch_functions_batch(relpaths):
+    # relpath -> [(name, srcabspath, srcline, vaddr), ...] for many binaries in
+    # one transfer, every source path string is shared by all of its rows
+    functions = {relpath: [] for relpath in relpaths}
+    srcabspaths = {}
+    for relpath, name, srcabspath, srcline, vaddr in stream_functions(functions):
+        srcabspath = srcabspaths.setdefault(srcabspath, srcabspath)
+        functions[relpath].append((name, srcabspath, srcline, vaddr))
+    return functions
+
+
+def fetch_functions(relpath):
+    # a named cursor costs extra round trips, one binary is a plain prepared query
+    if snapshot:
+        return [(json.loads(names)[0], srcabspath, srcline, vaddr)
+                for names, srcabspath, srcline, vaddr in fetch_snapshot(SNAPSHOT_FUNCTIONS_QUERY, (relpath,))]
+    return fetch(FUNCTIONS_QUERY, (relpath,))
+
+
+def fetch_package_units(limit=100):
+    if snapshot:
+        return fetch_snapshot(SNAPSHOT_PACKAGE_UNITS_QUERY, (limit,))
+    return fetch(PACKAGE_UNITS_QUERY, (limit,))
@@ -0,0 +1,90 @@
+import argparse
+import json
+import os
+import sqlite3
+
+import archsrc_db
+
+SCHEMA = """
+CREATE TABLE binaries (binary_id INTEGER, pkg TEXT, abspath TEXT, relpath TEXT, compileopt TEXT);
+CREATE TABLE binary_functions (binary_id INTEGER, name TEXT, srcabspath TEXT, srcline INTEGER, vaddr INTEGER);
+"""
+
+# what get_srcinfo_db and get_package_info_db look up by
+INDEXES = """
+CREATE INDEX binaries_relpath_compileopt ON binaries (relpath, compileopt);
+CREATE INDEX binaries_binary_id ON binaries (binary_id);
+CREATE INDEX binary_functions_binary_id ON binary_functions (binary_id);
+"""
+
+PACKAGES_QUERY = """SELECT DISTINCT pkg FROM binaries ORDER BY pkg LIMIT %s;"""
+BINARIES_QUERY = """SELECT binary_id, pkg, abspath, relpath, compileopt FROM binaries WHERE pkg = ANY(%s);"""
+FUNCTIONS_QUERY = """SELECT binary_id, name, srcabspath, srcline, vaddr FROM binary_functions
+               WHERE binary_id = ANY(%s);"""
+
+BATCH_ROWS = 10000
+
+
+def export_snapshot(path, packages=None, limit=None):
+    # binaries and binary_functions of the packages (or the first limit packages) -> SQLite file
+    if os.path.exists(path):
+        os.remove(path)
+    with archsrc_db.get_pool().connection() as conn:
+        if packages is None:
+            packages = [row[0] for row in conn.execute(PACKAGES_QUERY, (limit,)).fetchall()]
+        binaries = conn.execute(BINARIES_QUERY, (list(packages),)).fetchall()
+
+        snapshot = sqlite3.connect(path)
+        snapshot.executescript(SCHEMA)
+        snapshot.executemany("INSERT INTO binaries VALUES (?, ?, ?, ?, ?)", binaries)
+        functions = 0
+        # server-side cursor, the function rows of big packages are streamed
+        with conn.cursor(name="archsrc_snapshot") as cur:
+            cur.execute(FUNCTIONS_QUERY, ([row[0] for row in binaries],))
+            while True:
+                rows = cur.fetchmany(BATCH_ROWS)
+                if not rows:
+                    break
+                snapshot.executemany("INSERT INTO binary_functions VALUES (?, ?, ?, ?, ?)",
+                                     [(row[0], json.dumps(row[1]), row[2], row[3], row[4]) for row in rows])
+                functions += len(rows)
+    # indexes are built once the rows are in, that is faster than updating them per row
+    snapshot.executescript(INDEXES)
+    snapshot.commit()
+    snapshot.execute("VACUUM")
+    snapshot.close()
+    print(f"{len(packages)} packages, {len(binaries)} binaries, {functions} functions written to {path}")
+
+
+def import_snapshot(path):
+    # the reverse, e.g. to fill a scratch PostgreSQL database for the tests
+    snapshot = sqlite3.connect("file:%s?mode=ro" % path, uri=True)
+    with archsrc_db.get_pool().connection() as conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS binaries (binary_id int, pkg text, abspath text, relpath text, compileopt text)")
+        conn.execute("CREATE TABLE IF NOT EXISTS binary_functions (binary_id int, name text[], srcabspath text, srcline int, vaddr bigint)")
+        with conn.cursor() as cur:
+            with cur.copy("COPY binaries (binary_id, pkg, abspath, relpath, compileopt) FROM STDIN") as copy:
+                for row in snapshot.execute("SELECT * FROM binaries"):
+                    copy.write_row(row)
+            with cur.copy("COPY binary_functions (binary_id, name, srcabspath, srcline, vaddr) FROM STDIN") as copy:
+                for row in snapshot.execute("SELECT * FROM binary_functions"):
+                    copy.write_row((row[0], json.loads(row[1])) + tuple(row[2:]))
+    snapshot.close()
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--dsn", help="archsrc database connection string")
+    commands = arg_parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="copy packages from the database into a SQLite snapshot")
+    export_parser.add_argument("snapshot")
+    export_parser.add_argument("--packages", nargs="+", help="packages to copy")
+    export_parser.add_argument("--limit", type=int, default=100, help="without --packages, copy the first N packages")
+    import_parser = commands.add_parser("import", help="load a SQLite snapshot into the database")
+    import_parser.add_argument("snapshot")
+    args = arg_parser.parse_args()
+    archsrc_db.configure(args.dsn)
+    if args.command == "export":
+        export_snapshot(args.snapshot, args.packages, args.limit)
+    else:
+        import_snapshot(args.snapshot)
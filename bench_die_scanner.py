@@ -0,0 +1,72 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from elftools.elf.elffile import ELFFile
+
+import die_scanner
+from bench_function_names import synthetic_source
+from dwarf_functions import iter_subprograms, release_CU
+
+
+def build_synthetic_elf(tmpdir, functions):
+    # lots of types, locals and lexical blocks the scanner should skip over
+    source = os.path.join(tmpdir, "synthetic.c")
+    with open(source, 'wb') as file:
+        file.write(b"struct point { int x; int y; struct point *next; };\n")
+        file.write(synthetic_source(functions))
+        file.write(b"\nint main(void) { struct point p = { 1, 2, 0 }; { int inner = p.x; return inner; } }\n")
+    binary = os.path.join(tmpdir, "synthetic")
+    subprocess.run(["gcc", "-g", "-O0", "-o", binary, source], check=True)
+    return binary
+
+
+def scan_pyelftools(dwarf):
+    records = []
+    dies = 0
+    for CU in dwarf.iter_CUs():
+        dies += sum(1 for DIE in CU.iter_DIEs() if not DIE.is_null())
+        records.extend(iter_subprograms(CU))
+        release_CU(CU)
+    return records, dies
+
+
+def scan_fast(dwarf):
+    records = []
+    for CU in dwarf.iter_CUs():
+        records.extend(die_scanner.scan_subprograms(dwarf, CU))
+    return records
+
+
+def main(path):
+    # section loading is the same for both and not timed
+    with open(path, 'rb') as fo:
+        dwarf = ELFFile(fo).get_dwarf_info()
+        start = time.perf_counter()
+        old_records, dies = scan_pyelftools(dwarf)
+        old_time = time.perf_counter() - start
+
+    with open(path, 'rb') as fo:
+        dwarf = ELFFile(fo).get_dwarf_info()
+        start = time.perf_counter()
+        new_records = scan_fast(dwarf)
+        new_time = time.perf_counter() - start
+
+    print("%s: %d DIEs, %d subprograms" % (path, dies, len(old_records)))
+    print("pyelftools: %8.3f s  %10.0f DIEs/s" % (old_time, dies / old_time))
+    print("scanner:    %8.3f s  %10.0f DIEs/s  speedup: %.1fx" % (new_time, dies / new_time, old_time / new_time))
+    print("same subprograms:", old_records == new_records)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(sys.argv[1])
+    else:
+        tmpdir = tempfile.mkdtemp()
+        try:
+            main(build_synthetic_elf(tmpdir, 2000))
+        finally:
+            shutil.rmtree(tmpdir)
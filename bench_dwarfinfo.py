@@ -0,0 +1,180 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+from elftools.elf.elffile import ELFFile
+
+import dwarf_functions
+import dwarfinfo
+import result_cache
+from macro_aliases import MacroAliasCache
+
+# kinds of generated functions, every kind hits another verification path
+KINDS = ("plain", "define", "gl", "rpl")
+# results go here by default, not into whatever directory the benchmark runs in
+BENCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench")
+
+
+def function_kind(i):
+    return KINDS[i % len(KINDS)]
+
+
+def generate_corpus(root, files, functions):
+    # files x functions C sources plus a shared header, returns the source paths
+    paths = []
+    header = ["#define _GL_DEFINE(name) int name(int a) { return a + 1; }"]
+    for f in range(files):
+        lines = ['#include "corpus.h"', ""]
+        for i in range(functions):
+            name = "f%d_%d" % (f, i)
+            kind = function_kind(i)
+            if kind == "plain":
+                # found by tree-sitter as a definition
+                lines.append("int %s(int a) {\n    return a * %d;\n}" % (name, i))
+            elif kind == "define":
+                # defined under an alias, DWARF has the name after the #define
+                lines.append("#define wrap_%s %s\nint wrap_%s(int a) {\n    return a - %d;\n}" % (name, name, name, i))
+            elif kind == "gl":
+                # gnulib style wrapper, the name is on the line after the _GL_ macro
+                lines.append("_GL_DEFINE(\n    %s)" % name)
+            else:
+                # gnulib replacement, the header renames it to rpl_*
+                header.append("#define %s rpl_%s" % (name, name))
+                lines.append("int %s(int a) {\n    return a ^ %d;\n}" % (name, i))
+            lines.append("")
+        path = os.path.join(root, "file_%d.c" % f)
+        with open(path, 'w') as file:
+            file.write("\n".join(lines))
+        paths.append(path)
+    with open(os.path.join(root, "corpus.h"), 'w') as file:
+        file.write("\n".join(header) + "\n")
+    with open(os.path.join(root, "main.c"), 'w') as file:
+        file.write("int main(void) {\n    return 0;\n}\n")
+    return paths
+
+
+def build_corpus(root, paths):
+    binary = os.path.join(root, "corpus")
+    subprocess.run(["gcc", "-g", "-O0", "-o", binary, os.path.join(root, "main.c")] + paths, check=True)
+    return binary
+
+
+class Timings:
+    def __init__(self):
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def stage(self, name, calls=1):
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+        self.stages[name] = {"seconds": seconds, "calls": calls, "per_call_us": seconds / max(calls, 1) * 1e6}
+        print("%-20s %10.3f s %10d calls %12.1f us/call" % (name, seconds, calls, seconds / max(calls, 1) * 1e6))
+
+
+def reset_caches():
+    # every stage starts cold
+    dwarf_functions.source_cache.clear()
+    dwarf_functions.macro_alias_cache = MacroAliasCache()
+
+
+def run(root, files, functions, use_clang):
+    paths = generate_corpus(root, files, functions)
+    binary = build_corpus(root, paths)
+    timings = Timings()
+
+    with timings.stage("get_srcinfo"):
+        with open(binary, 'rb') as fo:
+            srcinfo = dwarf_functions.get_srcinfo(ELFFile(fo).get_dwarf_info())
+    srcinfo = [row for row in srcinfo if row.path in paths]
+    calls = len(srcinfo)
+
+    with timings.stage("get_code", len(paths)):
+        codes = {path: dwarfinfo.get_code(path) for path in paths}
+
+    with timings.stage("ts_get_function", calls):
+        for row in srcinfo:
+            dwarfinfo.ts_get_function(codes[row.path], row.name)
+
+    reset_caches()
+    with timings.stage("defines_extension", calls):
+        for row in srcinfo:
+            dwarf_functions.defines_extension(row.path, row.name)
+
+    if use_clang:
+        reset_caches()
+        rpl = [row for row in srcinfo if row.name.startswith("rpl_")]
+        with timings.stage("find_macro_chain", len(rpl)):
+            for row in rpl:
+                dwarf_functions.find_macro_chain(row.path, row.name)
+
+    reset_caches()
+    with timings.stage("pretty_print", calls):
+        with contextlib.redirect_stdout(io.StringIO()):
+            dwarfinfo.pretty_print(srcinfo, "")
+
+    reasons = {}
+    for row in srcinfo:
+        reasons[str(row.verification_reason)] = reasons.get(str(row.verification_reason), 0) + 1
+    print("verification reasons:", reasons)
+    return timings.stages, reasons
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(files, functions, output, lib_path, keep):
+    # the result cache would turn every run after the first into a lookup
+    result_cache.configure(use_cache=False)
+    if lib_path:
+        dwarf_functions.set_lib_path(lib_path)
+    root = tempfile.mkdtemp(prefix="bench_dwarfinfo_")
+    try:
+        stages, reasons = run(root, files, functions, bool(lib_path))
+    finally:
+        if keep:
+            print("corpus kept in", root)
+        else:
+            shutil.rmtree(root)
+
+    commit = git_commit()
+    result = {
+        "commit": commit,
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "files": files,
+        "functions_per_file": functions,
+        "libclang": bool(lib_path),
+        "stages": stages,
+        "verification_reasons": reasons,
+    }
+    if output is None:
+        os.makedirs(BENCH_DIR, exist_ok=True)
+        output = os.path.join(BENCH_DIR, "bench-%s.json" % (commit[:12] if commit else datetime.now().strftime("%Y-%m-%d-%H_%M_%S")))
+    with open(output, 'w') as file:
+        json.dump(result, file, indent=2)
+    print("results written to", output)
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--files", type=int, default=20, help="number of generated C files")
+    arg_parser.add_argument("--functions", type=int, default=100, help="functions per file")
+    arg_parser.add_argument("--output", "-o", help="JSON result file (default: bench/bench-<commit>.json next to this script)")
+    arg_parser.add_argument("--lib-path", default="", help="libclang.so, also times find_macro_chain")
+    arg_parser.add_argument("--keep", action="store_true", help="keep the generated corpus and binary")
+    args = arg_parser.parse_args()
+    main(args.files, args.functions, args.output, args.lib_path, args.keep)
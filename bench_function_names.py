@@ -0,0 +1,67 @@
+import glob
+import sys
+import time
+
+import dwarf_functions
+from ts_functions import function_names_in_tree
+
+
+def recursive_function_names(node):
+    # the recursive walk dwarfinfo.py used before function_names_in_tree,
+    # the reference the query results are compared with
+    function_names = []
+    find_function_names(node, function_names)
+    return frozenset(function_names)
+
+
+def find_function_names(node, function_names):
+    if str(node.type) == 'function_declarator' or str(node.type) == 'function_declaration':
+        for child in node.named_children:
+            if str(child.type) == 'identifier':
+                function_names.append(child.text.decode('utf-8'))
+    for child in node.named_children:
+        find_function_names(child, function_names)
+
+
+def synthetic_source(functions):
+    lines = []
+    for i in range(functions):
+        lines.append("static int table_%d[] = { %s };" % (i, ", ".join(str(x) for x in range(16))))
+        lines.append("int func_%d(int a, char *(*cb)(int)) {" % i)
+        lines.append("    if (a > %d) { return a - 1; } else { return table_%d[a & 15]; }" % (i, i))
+        lines.append("}")
+        lines.append("int proto_%d(void);" % i)
+    return "\n".join(lines).encode('utf-8')
+
+
+def time_extractor(extract, root, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        names = extract(root)
+    return (time.perf_counter() - start) / repeat, names
+
+
+def bench(label, code, repeat):
+    tree = dwarf_functions.parser.parse(code)
+    try:
+        old_time, old_names = time_extractor(recursive_function_names, tree.root_node, repeat)
+    except RecursionError:
+        old_time, old_names = None, None
+    new_time, new_names = time_extractor(function_names_in_tree, tree.root_node, repeat)
+
+    if old_time is None:
+        print("%-32s %8d names  recursive: RecursionError  query: %9.3f ms" % (label, len(new_names), new_time * 1000))
+        return
+    print("%-32s %8d names  recursive: %9.3f ms  query: %9.3f ms  speedup: %6.1fx  same: %s" % (
+        label, len(new_names), old_time * 1000, new_time * 1000, old_time / new_time, old_names == new_names))
+
+
+def main(functions):
+    for path in sorted(glob.glob("testfiles/*")):
+        with open(path, 'rb') as file:
+            bench(path, file.read(), 200)
+    bench("synthetic (%d functions)" % functions, synthetic_source(functions), 3)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,265 @@
+import weakref
+
+# children of these DIEs are searched for subprograms, the subtrees of every
+# other DIE (types, variables, ...) are skipped. GNU C nested functions can sit
+# in a lexical block of the function around them.
+DESCEND_TAGS = frozenset(['DW_TAG_compile_unit', 'DW_TAG_partial_unit', 'DW_TAG_namespace', 'DW_TAG_subprogram',
+                          'DW_TAG_lexical_block'])
+
+# the only attributes that are decoded, everything else is skipped by its form
+NAME, DECL_FILE, DECL_LINE, LOW_PC, DECLARATION, SIBLING = range(6)
+ATTRIBUTES = {
+    'DW_AT_name': NAME,
+    'DW_AT_decl_file': DECL_FILE,
+    'DW_AT_decl_line': DECL_LINE,
+    'DW_AT_low_pc': LOW_PC,
+    'DW_AT_declaration': DECLARATION,
+    'DW_AT_sibling': SIBLING,
+}
+
+# sizes of forms that are not fixed
+ULEB, SLEB, CSTRING, BLOCK1, BLOCK2, BLOCK4, BLOCK, IMPLICIT = range(-1, -9, -1)
+
+FIXED_FORMS = {
+    'DW_FORM_flag_present': 0,
+    'DW_FORM_data1': 1, 'DW_FORM_ref1': 1, 'DW_FORM_flag': 1, 'DW_FORM_strx1': 1, 'DW_FORM_addrx1': 1,
+    'DW_FORM_data2': 2, 'DW_FORM_ref2': 2, 'DW_FORM_strx2': 2, 'DW_FORM_addrx2': 2,
+    'DW_FORM_strx3': 3, 'DW_FORM_addrx3': 3,
+    'DW_FORM_data4': 4, 'DW_FORM_ref4': 4, 'DW_FORM_strx4': 4, 'DW_FORM_addrx4': 4, 'DW_FORM_ref_sup4': 4,
+    'DW_FORM_data8': 8, 'DW_FORM_ref8': 8, 'DW_FORM_ref_sig8': 8, 'DW_FORM_ref_sup8': 8,
+    'DW_FORM_data16': 16,
+}
+OFFSET_FORMS = frozenset(['DW_FORM_strp', 'DW_FORM_line_strp', 'DW_FORM_sec_offset', 'DW_FORM_strp_sup',
+                          'DW_FORM_GNU_strp_alt', 'DW_FORM_GNU_ref_alt'])
+VARIABLE_FORMS = {
+    'DW_FORM_udata': ULEB, 'DW_FORM_ref_udata': ULEB, 'DW_FORM_strx': ULEB, 'DW_FORM_addrx': ULEB,
+    'DW_FORM_loclistx': ULEB, 'DW_FORM_rnglistx': ULEB, 'DW_FORM_GNU_addr_index': ULEB,
+    'DW_FORM_GNU_str_index': ULEB,
+    'DW_FORM_sdata': SLEB,
+    'DW_FORM_string': CSTRING,
+    'DW_FORM_block1': BLOCK1, 'DW_FORM_block2': BLOCK2, 'DW_FORM_block4': BLOCK4,
+    'DW_FORM_block': BLOCK, 'DW_FORM_exprloc': BLOCK,
+    'DW_FORM_implicit_const': IMPLICIT,
+}
+CONSTANT_FORMS = frozenset(['DW_FORM_data1', 'DW_FORM_data2', 'DW_FORM_data4', 'DW_FORM_data8',
+                            'DW_FORM_udata', 'DW_FORM_sdata', 'DW_FORM_implicit_const'])
+CU_REFERENCE_FORMS = frozenset(['DW_FORM_ref1', 'DW_FORM_ref2', 'DW_FORM_ref4', 'DW_FORM_ref8',
+                                'DW_FORM_ref_udata'])
+
+
+class UnsupportedForm(Exception):
+    # the CU has to go through the full pyelftools DIE parser instead
+    pass
+
+
+def read_uleb(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def read_sleb(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            if byte & 0x40:
+                result -= 1 << shift
+            return result, pos
+
+
+class DieScanner:
+    # walks the raw .debug_info of one DWARFInfo and only looks at subprograms
+    def __init__(self, dwarf):
+        self.dwarf = dwarf
+        self.info = dwarf.debug_info_sec.stream.getvalue()
+        self.debug_str = dwarf.debug_str_sec.stream.getvalue() if dwarf.debug_str_sec else b''
+        line_str_sec = getattr(dwarf, 'debug_line_str_sec', None)
+        self.debug_line_str = line_str_sec.stream.getvalue() if line_str_sec else b''
+        self.byteorder = 'little' if dwarf.config.little_endian else 'big'
+        # interned names per string section offset
+        self.strings = {}
+        self.line_strings = {}
+        self.plans = {}
+        self.dies = 0
+
+    def get_plans(self, CU):
+        key = (CU['debug_abbrev_offset'], CU['address_size'], CU.structs.dwarf_format, CU['version'])
+        plans = self.plans.get(key)
+        if plans is None:
+            plans = self.plans[key] = {}
+        return plans
+
+    def build_plan(self, CU, code):
+        # (is subprogram, descend into children, has children, [(attribute, form, size, const)])
+        try:
+            abbrev = self.dwarf.get_abbrev_table(CU['debug_abbrev_offset']).get_abbrev(code)
+        except KeyError:
+            raise UnsupportedForm("unknown abbreviation code %d" % code)
+        address_size = CU['address_size']
+        offset_size = CU.structs.dwarf_format // 8
+        specs = []
+        for spec in abbrev['attr_spec']:
+            form = spec.form
+            if form == 'DW_FORM_addr':
+                size = address_size
+            elif form == 'DW_FORM_ref_addr':
+                size = address_size if CU['version'] == 2 else offset_size
+            elif form in OFFSET_FORMS:
+                size = offset_size
+            elif form in FIXED_FORMS:
+                size = FIXED_FORMS[form]
+            elif form in VARIABLE_FORMS:
+                size = VARIABLE_FORMS[form]
+            else:
+                raise UnsupportedForm(form)
+            specs.append((ATTRIBUTES.get(spec.name), form, size, spec.value))
+        tag = abbrev['tag']
+        return (tag == 'DW_TAG_subprogram', tag in DESCEND_TAGS, abbrev.has_children(), specs)
+
+    def read_string(self, form, data, pos, size):
+        if form == 'DW_FORM_string':
+            end = data.index(b'\0', pos)
+            return data[pos:end].decode('latin-1')
+        if form == 'DW_FORM_strp':
+            section, strings = self.debug_str, self.strings
+        elif form == 'DW_FORM_line_strp':
+            section, strings = self.debug_line_str, self.line_strings
+        else:
+            raise UnsupportedForm(form)
+        offset = int.from_bytes(data[pos:pos + size], self.byteorder)
+        name = strings.get(offset)
+        if name is None:
+            name = strings[offset] = section[offset:section.index(b'\0', offset)].decode('latin-1')
+        return name
+
+    def scan(self, CU):
+        # returns (name, decl_file, decl_line, declaration, low_pc) per subprogram,
+        # None for a missing name, file or line
+        data = self.info
+        byteorder = self.byteorder
+        plans = self.get_plans(CU)
+        cu_offset = CU.cu_offset
+        pos = CU.cu_die_offset
+        end = cu_offset + CU['unit_length'] + CU.structs.initial_length_field_size()
+        depth = 0
+        # depth of a childful DIE without DW_AT_sibling whose subtree is being skipped
+        skip_depth = None
+        records = []
+        dies = 0
+
+        while pos < end:
+            code, pos = read_uleb(data, pos)
+            if code == 0:
+                if depth > 0:
+                    depth -= 1
+                if skip_depth is not None and depth == skip_depth:
+                    skip_depth = None
+                continue
+            dies += 1
+            plan = plans.get(code)
+            if plan is None:
+                plan = plans[code] = self.build_plan(CU, code)
+            is_subprogram, descend, has_children, specs = plan
+            report = is_subprogram and skip_depth is None
+
+            name = decl_file = decl_line = sibling = None
+            declaration = False
+            low_pc = 0
+            for attribute, form, size, const in specs:
+                if attribute is None or (not report and attribute != SIBLING):
+                    if size >= 0:
+                        pos += size
+                    elif size == ULEB or size == SLEB:
+                        while data[pos] >= 0x80:
+                            pos += 1
+                        pos += 1
+                    elif size == CSTRING:
+                        pos = data.index(b'\0', pos) + 1
+                    elif size == BLOCK1:
+                        pos += 1 + data[pos]
+                    elif size == BLOCK2:
+                        pos += 2 + int.from_bytes(data[pos:pos + 2], byteorder)
+                    elif size == BLOCK4:
+                        pos += 4 + int.from_bytes(data[pos:pos + 4], byteorder)
+                    elif size == BLOCK:
+                        length, pos = read_uleb(data, pos)
+                        pos += length
+                    continue
+
+                if size == IMPLICIT:
+                    value = const
+                elif size == ULEB:
+                    value, pos = read_uleb(data, pos)
+                    size = 0
+                elif size == SLEB:
+                    value, pos = read_sleb(data, pos)
+                    size = 0
+                elif size == CSTRING:
+                    value = None
+                elif size >= 0:
+                    value = int.from_bytes(data[pos:pos + size], byteorder)
+                else:
+                    raise UnsupportedForm(form)
+
+                if attribute == NAME:
+                    name = self.read_string(form, data, pos, size)
+                    if size == CSTRING:
+                        size = data.index(b'\0', pos) + 1 - pos
+                elif attribute == DECL_FILE or attribute == DECL_LINE:
+                    if form not in CONSTANT_FORMS:
+                        raise UnsupportedForm(form)
+                    if attribute == DECL_FILE:
+                        decl_file = value
+                    else:
+                        decl_line = value
+                elif attribute == LOW_PC:
+                    if form != 'DW_FORM_addr':
+                        raise UnsupportedForm(form)
+                    low_pc = value
+                elif attribute == DECLARATION:
+                    declaration = True if form == 'DW_FORM_flag_present' else bool(value)
+                elif attribute == SIBLING:
+                    if form in CU_REFERENCE_FORMS:
+                        sibling = cu_offset + value
+                    elif form == 'DW_FORM_ref_addr':
+                        sibling = value
+                if size > 0:
+                    pos += size
+
+            if report:
+                records.append((name, decl_file, decl_line, declaration, low_pc))
+            if has_children:
+                if descend and skip_depth is None:
+                    depth += 1
+                elif sibling is not None:
+                    if sibling <= pos or sibling > end:
+                        raise UnsupportedForm("bad DW_AT_sibling")
+                    pos = sibling
+                else:
+                    if skip_depth is None:
+                        skip_depth = depth
+                    depth += 1
+
+        self.dies += dies
+        return records
+
+
+_scanners = weakref.WeakKeyDictionary()
+
+
+def scan_subprograms(dwarf, CU):
+    scanner = _scanners.get(dwarf)
+    if scanner is None:
+        scanner = _scanners[dwarf] = DieScanner(dwarf)
+    return scanner.scan(CU)
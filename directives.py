@@ -0,0 +1,39 @@
+import re
+
+# "#define alias replacement", the # has to start the line and the whole
+# directive has to be on one line. The replacement's leading identifier is the
+# name it is looked up by.
+DEFINE_RE = re.compile(rb"^#[^\S\n]*define[^\S\n]+(\S+)[^\S\n]+([A-Za-z_]\w*)", re.MULTILINE)
+GL_MARKER = b'_GL_'
+IDENTIFIER_RE = re.compile(rb"[A-Za-z_]\w*")
+
+
+def decode(name):
+    return name.decode('utf-8', 'replace')
+
+
+class DirectiveIndex:
+    # one pass over a source file for the regex fallbacks: replacement name ->
+    # #define aliases in file order, and the identifiers on the line after a
+    # _GL_ marker. code is bytes or an mmap.
+    def __init__(self, code):
+        if isinstance(code, str):
+            code = code.encode('utf-8')
+        self.defines = {}
+        for match in DEFINE_RE.finditer(code):
+            self.defines.setdefault(decode(match.group(2)), []).append(decode(match.group(1)))
+
+        self.gl_identifiers = set()
+        pos = code.find(GL_MARKER)
+        while pos != -1:
+            next_line = code.find(b'\n', pos) + 1
+            if next_line == 0:
+                break
+            end = code.find(b'\n', next_line)
+            if end == -1:
+                end = len(code)
+            self.gl_identifiers.update(decode(name) for name in IDENTIFIER_RE.findall(code, next_line, end))
+            pos = code.find(GL_MARKER, next_line)
+
+    def aliases(self, name):
+        return self.defines.get(name, ())
@@ -0,0 +1,256 @@
+# DWARF function extraction and source file verification, shared by
+# dwarfinfo.py and dwarfinfo_return.py
+import os
+from tree_sitter import Parser, Language
+import tree_sitter_c as ts_c
+import clang.cindex
+
+import archsrc_db
+import instrumentation
+import result_cache
+import symbol_index
+from die_scanner import scan_subprograms, UnsupportedForm
+from line_tables import line_table_paths
+from macro_aliases import MacroAliasCache
+from rename_rules import RenameResolver
+from source_cache import SourceCache
+from ts_functions import function_names_in_tree, function_definitions
+
+LIBPATH = None
+
+# tree-sitter global object
+C_LANGUAGE = Language(ts_c.language())
+parser = Parser(C_LANGUAGE)
+
+# parsed source files, shared by all lookups of a run
+source_cache = SourceCache(parser, function_names_in_tree, function_definitions)
+
+# parsed macro alias graphs, one per translation unit
+macro_alias_cache = MacroAliasCache()
+
+# rpl_ / i_ / _unlocked / ... variants, see rename_rules.py
+rename_resolver = RenameResolver()
+
+
+def reset(use_mmap=False, rename_rules=None):
+    # a new parser and new caches, e.g. in a worker process
+    global parser, source_cache, macro_alias_cache, rename_resolver
+    parser = Parser(C_LANGUAGE)
+    source_cache = SourceCache(parser, function_names_in_tree, function_definitions, use_mmap=use_mmap)
+    macro_alias_cache = MacroAliasCache()
+    if rename_rules is not None:
+        rename_resolver = RenameResolver(rename_rules)
+
+def set_lib_path(lib_path):
+    global LIBPATH
+    LIBPATH = lib_path
+    # a forked worker inherits the setting, libclang refuses a second call once loaded
+    if not clang.cindex.Config.loaded and clang.cindex.Config.library_file != lib_path:
+        clang.cindex.Config.set_library_file(lib_path)
+
+
+class DwarfFunctionInfo:
+    def __init__(self, name, path, line, offset):
+        self.name = name
+        self.path = path
+        self.line = line
+        self.offset = offset
+        self.verification = False
+        self.verification_reason = None
+@instrumentation.timed("get_srcinfo_db")
+def get_srcinfo_db(path):
+    return [DwarfFunctionInfo(*row) for row in archsrc_db.fetch_functions(db_relpath(path))]
+
+def db_relpath(path):
+    return 'usr/{path}'.format(path=path)
+
+def get_srcinfo(dwarf, accel=None):
+    function_container = []
+    # srcinfo = defaultdict(list)
+    for functions in iter_srcinfo(dwarf, accel):
+        function_container.extend(functions)
+    return function_container
+
+def iter_srcinfo(dwarf, accel=None):
+    # yields the functions of one CU at a time, so only one CU's DIEs are in memory.
+    # accel is a load_accelerator_index result, its CUs are not walked
+    for CU in dwarf.iter_CUs():
+        functions = get_cu_srcinfo(dwarf, CU, accel.get(CU.cu_offset) if accel else None)
+        release_CU(CU)
+        yield functions
+
+def release_CU(CU):
+    # pyelftools keeps every DIE it decoded in the CU object, which its
+    # DWARFInfo caches. These are private, so only cleared where they exist.
+    for attribute in ('_dielist', '_diemap'):
+        if hasattr(CU, attribute):
+            setattr(CU, attribute, [])
+
+@instrumentation.timed("get_srcinfo")
+def get_cu_srcinfo(dwarf, CU, die_offsets=None):
+    function_container = []
+    # file index -> joined path, shared by all CUs with the same line table
+    file_paths = line_table_paths(dwarf, CU)
+    if die_offsets is not None:
+        subprograms = listed_subprograms(CU, die_offsets)
+    else:
+        try:
+            subprograms = scan_subprograms(dwarf, CU)
+        except UnsupportedForm:
+            subprograms = iter_subprograms(CU)
+    for name, file_idx, line, declaration, offset in subprograms:
+        # a missing name, file or line ends the CU, like the KeyError did before
+        if name is None or file_idx not in file_paths or line is None:
+            break
+        path = file_paths[file_idx]
+        if declaration:
+            continue
+        function_container.append(DwarfFunctionInfo(name, path, line, offset))
+    return function_container
+
+def iter_subprograms(CU):
+    # full pyelftools DIE parsing, for CUs the die_scanner cannot handle
+    for DIE in CU.iter_DIEs():
+        if DIE.tag == 'DW_TAG_subprogram':
+            yield subprogram_record(DIE)
+
+def listed_subprograms(CU, die_offsets):
+    # only the DIEs an accelerator table points at
+    for offset in die_offsets:
+        yield subprogram_record(CU.get_DIE_from_refaddr(offset))
+
+def subprogram_record(DIE):
+    attributes = DIE.attributes
+    name = attributes['DW_AT_name'].value.decode('latin-1') if 'DW_AT_name' in attributes else None
+    file_idx = attributes['DW_AT_decl_file'].value if 'DW_AT_decl_file' in attributes else None
+    line = attributes['DW_AT_decl_line'].value if 'DW_AT_decl_line' in attributes else None
+    declaration = attributes['DW_AT_declaration'].value if 'DW_AT_declaration' in attributes else False
+    offset = attributes['DW_AT_low_pc'].value if 'DW_AT_low_pc' in attributes else 0
+    return name, file_idx, line, declaration, offset
+
+def check_accelerator(dwarf, accel):
+    # parity check: the accelerator table has to give the same functions as the full walk
+    def function_set(srcinfo):
+        return set((row.name, row.path, row.line, row.offset) for row in srcinfo)
+    walked = get_srcinfo(dwarf)
+    walked_set, accel_set = function_set(walked), function_set(get_srcinfo(dwarf, accel))
+    missing = walked_set - accel_set
+    extra = accel_set - walked_set
+    for function in sorted(missing):
+        print("Missing from accelerator table:", function)
+    for function in sorted(extra):
+        print("Only in accelerator table:", function)
+    return walked, not missing and not extra
+
+
+def get_cached_srcinfo(cache, key):
+    functions = cache.get_srcinfo(key)
+    if functions is None:
+        return None
+    return [DwarfFunctionInfo(*function) for function in functions]
+
+def put_cached_srcinfo(cache, key, srcinfo):
+    cache.put_srcinfo(key, [(row.name, row.path, row.line, row.offset) for row in srcinfo])
+
+
+def verification_mode():
+    # libclang finds macro aliases the regex fallback misses, and the
+    # rename rules decide which renamed functions are found
+    return "%s:rules-%s" % ("clang" if LIBPATH else "regex", rename_resolver.digest())
+
+@instrumentation.timed("verify_file")
+def verify_file(path, rows):
+    index = symbol_index.get_index()
+    if index is None:
+        verify_source(path, rows)
+        return
+    if os.path.exists(path):
+        verify_source(path, rows)
+    else:
+        # the DWARF path does not map into src_path, only the index can help
+        for row in rows:
+            row.verification_reason = None
+            row.verification = False
+    # last resort: defined anywhere in the indexed source tree
+    for row in rows:
+        if row.verification_reason is None and index.defined(row.name):
+            row.verification_reason = "elsewhere"
+            row.verification = True
+            instrumentation.count("verification:elsewhere")
+
+def verify_source(path, rows):
+    cache = result_cache.get_cache()
+    if cache is not None:
+        # the reasons only depend on the source file's content
+        source_hash = result_cache.source_hash(path)
+        cached = cache.get_verifications(source_hash, verification_mode(), set(row.name for row in rows))
+        for row in rows:
+            if row.name in cached:
+                row.verification_reason = cached[row.name]
+                row.verification = row.verification_reason is not None
+                instrumentation.count("verification:%s" % (row.verification_reason or "failed"))
+        instrumentation.count("verification_cached", len(cached))
+        rows = [row for row in rows if row.name not in cached]
+        if not rows:
+            return
+    source = source_cache.get(path)
+    for row in rows:
+        if row.name in source.get_definitions():
+            row.verification_reason = "definition"
+        elif row.name in source.function_names:
+            row.verification_reason = "tree-sitter"
+        elif row.name in source.get_directives().gl_identifiers:
+            row.verification_reason = "_GL_"
+        else:
+            row.verification_reason = defines_extension(path, row.name)
+        row.verification = row.verification_reason is not None
+        instrumentation.count("verification:%s" % (row.verification_reason or "failed"))
+    if cache is not None:
+        cache.put_verifications(source_hash, verification_mode(),
+                                {row.name: row.verification_reason for row in rows})
+
+
+def tree_sitter_finding_bool(path, name):
+    #print_if(path, name)
+    source = source_cache.get(path)
+    if name in source.function_names:
+        return True
+    return name in source.get_directives().gl_identifiers
+
+
+@instrumentation.timed("defines_extension")
+def defines_extension(path, name):
+    # "defines" if a #define or macro alias of name is defined in the file,
+    # "renamed:<rule>" if a renamed variant is, None otherwise
+    #print("defines_extension for: ",name," and ", path)
+    source = source_cache.get(path)
+    directives = source.get_directives()
+    aliases = directives.aliases(name)
+    if aliases and any(tree_sitter_finding_bool(path, alias) for alias in aliases):
+        return "defines"
+    if LIBPATH is not None and renaming_preprocessor(path, name):
+        return "defines"
+    # every candidate of every rename rule against the names already in the cache
+    match = rename_resolver.resolve(name, source.function_names, directives.gl_identifiers)
+    if match is not None:
+        instrumentation.count("rename_rule:" + match[1])
+        return "renamed:" + match[1]
+    return None
+
+def renaming_preprocessor(path, name):
+    includes = ["~/scripts/include", "lib/*"]
+    aliases = find_macro_chain(path, name, includes)
+    for alias in aliases:
+        if tree_sitter_finding_bool(path, alias):
+            return True
+    else:
+        return False
+
+
+@instrumentation.timed("find_macro_chain")
+def find_macro_chain(filename, target_name, include_dirs=None):
+
+    if include_dirs is None:
+        include_dirs = []
+
+    return macro_alias_cache.get(filename, include_dirs).alias_chain(target_name)
@@ -1,176 +1,269 @@
 # from collections import defaultdict
-import os, sys, re
+import re
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 from elftools.elf.elffile import ELFFile
 from prettytable import PrettyTable
-from tree_sitter import Parser, Language
-import tree_sitter_c as ts_c
-import psycopg
-import clang.cindex
-
-function_names = []
-LIBPATH = None
-
-
-def find_macro_chain(filename, target_name, include_dirs=None):
-
-    if include_dirs is None:
-        include_dirs = []
-
-    args = [f"-I{inc}" for inc in include_dirs]
-    index = clang.cindex.Index.create()
-    tu = index.parse(filename, args=args)
-
-    # check for defines
-    macro_map = {}
-    for cursor in tu.cursor.walk_preorder():
-        if cursor.kind == clang.cindex.CursorKind.MACRO_DEFINITION:
-            tokens = list(cursor.get_tokens())
-            if len(tokens) >= 3:
-                name = tokens[1].spelling
-                replacement = " ".join(tok.spelling for tok in tokens[2:])
-                macro_map[name] = replacement
-
-    # recursive alias find
-    result = []
-
-    def resolve_aliases(name):
-        for alias, real in macro_map.items():
-            if real == name and alias not in result:
-                result.append(alias)
-                resolve_aliases(alias)
-
-    resolve_aliases(target_name)
-    return result
-
-
-# tree-sitter global object
-C_LANGUAGE = Language(ts_c.language())
-parser = Parser(C_LANGUAGE)
-
-FUNCTION_QUERY= """
-(
-    ( function_definition
-        declarator: ( function_declarator
-            declarator: (identifier) @function_names (#eq? @function_names "{function_name}")
-        )
-        body: (compound_statement) @function.body
-    )
-)
-"""
-class CFunction:
-    def __init__(self, tree, function_name):
-        function_query = C_LANGUAGE.query(FUNCTION_QUERY.format(function_name=function_name))
-        function_captures = function_query.captures(tree.root_node)
 
-        if function_captures:
-            self.function_node = function_captures['function_names'][0]
+import archsrc_db
+import dwarf_functions
+import instrumentation
+import profiling
+import result_cache
+import symbol_index
+from accel_tables import load_accelerator_index
+from directives import DirectiveIndex
+from dwarf_functions import get_srcinfo_db, get_srcinfo, iter_srcinfo, release_CU, get_cu_srcinfo, \
+    check_accelerator, get_cached_srcinfo, put_cached_srcinfo, set_lib_path, verify_file
+from rename_rules import RenameResolver, DEFAULT_RULES
+from ts_functions import function_names_in_tree, function_definitions
+
+
+class CFunction:
+    def __init__(self, tree, function_name, definitions=None):
+        # pass the function_definitions(tree) map when looking up many names
+        if definitions is None:
+            definitions = function_definitions(tree)
+        definition = definitions.get(function_name)
+
+        if definition is not None:
+            self.function_node = definition.node
+            self.body_range = definition.body_range
+            self.start_line = definition.start_line
         else:
             #print("Tree sitter CFunction error for:", function_name)
             self.function_node = None
+            self.body_range = None
+            self.start_line = None
+
+
+@instrumentation.timed("get_srcinfo_parallel")
+def get_srcinfo_parallel(path, jobs, use_accel=True):
+    # CU offsets are enumerated once here, the workers decode disjoint ranges
+    # of them and the results are merged back in CU order
+    global _decode_dwarf
+    with open(path, 'rb') as fo:
+        elffile = ELFFile(fo)
+        if not elffile.has_dwarf_info():
+            return None
+        accel = load_accelerator_index(elffile) if use_accel else None
+        dwarf = elffile.get_dwarf_info()
+        offsets = [(CU.cu_offset, accel.get(CU.cu_offset) if accel else None) for CU in dwarf.iter_CUs()]
+    chunksize = max(1, -(-len(offsets) // (jobs * 4)))
+    ranges = [offsets[i:i + chunksize] for i in range(0, len(offsets), chunksize)]
 
-
-class DwarfFunctionInfo:
-    def __init__(self, name, path, line, offset):
-        self.name = name
-        self.path = path
-        self.line = line
-        self.offset = offset
-        self.verification = False
-        self.verification_reason = None
-
-def get_srcinfo_db(path):
-    # DB Conn
-    conn = psycopg.connect(
-        dbname="archsrc",
-        user="rouser",
-        password="",
-        host="kuria",
-        port="5432"
-    )
-
-    query = """SELECT name, srcabspath, srcline, vaddr
-               FROM binary_functions
-               WHERE binary_id = (SELECT binary_id
-                   FROM binaries
-               WHERE compileopt = '00000' and relpath = 'usr/{path}');""".format(path=path)
     function_container = []
-    with conn.cursor() as cur:
-        cur.execute(query)
-        rows = cur.fetchall()
-        for row in rows:
-            print(row[0][0], row[1], row[3])
-            if row[1] != None:
-                function_container.append(DwarfFunctionInfo(row[0][0], row[1], row[2], row[3]))
-
-    conn.close()
+    # the workers are forked after this and share the parent's DWARF sections
+    # copy-on-write instead of each reading its own copy
+    _decode_dwarf = (path, dwarf)
+    try:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=profiling.configure_worker,
+                                 initargs=(profiling.directory,)) as executor:
+            for functions, summary in executor.map(decode_cu_range, [path] * len(ranges), ranges):
+                instrumentation.merge(summary)
+                function_container.extend(functions)
+    finally:
+        _decode_dwarf = None
     return function_container
 
-def get_srcinfo(dwarf):
+# (path, DWARFInfo) the decode workers inherit from get_srcinfo_parallel. A worker
+# only reads the binary itself if it was not forked, e.g. with the spawn start method.
+_decode_dwarf = None
+
+def load_decode_dwarf(path):
+    global _decode_dwarf
+    if _decode_dwarf is None or _decode_dwarf[0] != path:
+        _decode_dwarf = None
+        # pyelftools reads the DWARF sections into memory, the file is not needed afterwards
+        with instrumentation.stage("load_dwarf"), open(path, 'rb') as fo:
+            _decode_dwarf = (path, ELFFile(fo).get_dwarf_info())
+    return _decode_dwarf[1]
+
+@profiling.profiled
+def decode_cu_range(path, offsets):
+    # offsets are (CU offset, subprogram DIE offsets from the accelerator table or None),
+    # returns the functions and the timings and counters of this range
+    instrumentation.reset()
+    dwarf = load_decode_dwarf(path)
     function_container = []
-    # srcinfo = defaultdict(list)
-    for CU in dwarf.iter_CUs():
-        lineprog = dwarf.line_program_for_CU(CU)
-        file_entries = lineprog.header['file_entry']
-        dir_entries = lineprog.header['include_directory']
-        file_table, dir_table = dict(), dict()
-        #funcnames = set()
-        for i, entry in enumerate(file_entries):
-            file_table[i] = (entry.dir_index, entry.name.decode('latin-1'))
-        for i, entry in enumerate(dir_entries):
-            dir_table[i] = entry.decode('latin-1')
-        try:
-            for DIE in CU.iter_DIEs():
-                if DIE.tag == 'DW_TAG_subprogram':
-                    name = DIE.attributes['DW_AT_name'].value.decode('latin-1')
-                    file_idx = DIE.attributes['DW_AT_decl_file'].value
-                    dir_idx, file_name = file_table[file_idx]
-                    dir_name = dir_table[dir_idx]
-                    line = DIE.attributes['DW_AT_decl_line'].value
-                    path = os.path.join(dir_name, file_name)
-                    try:
-                        declaration = DIE.attributes['DW_AT_declaration'].value
-                    except KeyError:
-                        declaration = False
-                    if declaration:
-                        continue
-                    try:
-                        offset = DIE.attributes['DW_AT_low_pc'].value
-                    except KeyError:
-                        offset = 0
-
-                    function_container.append(DwarfFunctionInfo(name, path, line, offset))
-
-        except KeyError:
-            continue
-    return function_container
+    for offset, die_offsets in offsets:
+        CU = dwarf.get_CU_at(offset)
+        function_container.extend(get_cu_srcinfo(dwarf, CU, die_offsets))
+        release_CU(CU)
+    return function_container, instrumentation.summary()
 
-def main(path, src_path, db, lib_path):
+def main(path, src_path, db, lib_path, jobs=1, stream=False, use_accel=True, accel_check=False):
 
     # lib path
     # like ("/usr/lib/llvm-VERSION/lib/libclang.so")
     if lib_path != "":
-        global LIBPATH
-        LIBPATH = lib_path
-        clang.cindex.Config.set_library_file(lib_path)
+        set_lib_path(lib_path)
 
     print("Starting script for " + path + " ...")
     # check for DWARF information
     srcinfo = None
+    cache = None
     if db:
         srcinfo = get_srcinfo_db(path)
-    else:
-        with open(path, 'rb') as fo:
-            elffile = ELFFile(fo)
-            if elffile.has_dwarf_info():
-                dwarfinfo = elffile.get_dwarf_info()
-                srcinfo = get_srcinfo(dwarfinfo)
-    pretty_print(srcinfo, src_path)
+    elif not accel_check:
+        # same build-id, same functions
+        cache = result_cache.get_cache()
+        if cache is not None:
+            cache_key = result_cache.binary_key(path)
+            srcinfo = get_cached_srcinfo(cache, cache_key)
+    if srcinfo is None:
+        if jobs > 1 and not stream and not accel_check:
+            srcinfo = get_srcinfo_parallel(path, jobs, use_accel)
+        else:
+            with open(path, 'rb') as fo:
+                elffile = ELFFile(fo)
+                if elffile.has_dwarf_info():
+                    dwarfinfo = elffile.get_dwarf_info()
+                    # .debug_names / .gdb_index, None if the binary has neither
+                    accel = load_accelerator_index(elffile) if use_accel or accel_check else None
+                    if accel_check:
+                        if accel is None:
+                            print("No usable .debug_names or .gdb_index")
+                            srcinfo = get_srcinfo(dwarfinfo)
+                        else:
+                            srcinfo, same = check_accelerator(dwarfinfo, accel)
+                            print("Accelerator table parity:", "OK" if same else "MISMATCH")
+                    elif stream:
+                        # verify every CU while the next ones are still undecoded
+                        extracted = [] if cache is not None else None
+                        stream_print(iter_srcinfo(dwarfinfo, accel), src_path, jobs, extracted)
+                        if cache is not None:
+                            cache.put_srcinfo(cache_key, extracted)
+                        return
+                    else:
+                        srcinfo = get_srcinfo(dwarfinfo, accel)
+        if cache is not None and srcinfo is not None:
+            put_cached_srcinfo(cache, cache_key, srcinfo)
+    pretty_print(srcinfo, src_path, jobs)
 
 
 def determine_compiler():
     return ".c"
 
-def pretty_print(srcinfo, src_path):
+def combined_source_path(src_path, path):
+    if path.startswith('../'):
+        return src_path + path.replace('../', '')
+    return src_path + path
+
+def verify_functions(srcinfo, resolve_path, jobs=1, executor=None):
+    # bucket the functions by source file so every file is indexed once,
+    # the rows keep their original order in srcinfo
+    files = {}
+    for row in srcinfo:
+        files.setdefault(resolve_path(row), []).append(row)
+    if executor is not None:
+        verify_files_parallel(files, executor, jobs)
+    elif jobs > 1 and len(files) > 1:
+        with verify_executor(jobs) as executor:
+            verify_files_parallel(files, executor, jobs)
+    else:
+        for path, rows in files.items():
+            verify_file(path, rows)
+    return files
+
+def verify_executor(jobs):
+    return ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                               initargs=(dwarf_functions.LIBPATH, result_cache.path, result_cache.enabled, profiling.directory,
+                                         dwarf_functions.source_cache.use_mmap,
+                                         [rule.spec for rule in dwarf_functions.rename_resolver.rules],
+                                         symbol_index.path))
+
+def verify_files_parallel(files, executor, jobs):
+    collect_files(*submit_files(files, executor, jobs))
+
+def submit_files(files, executor, jobs):
+    # one task per source file, the results are read by collect_files
+    items = list(files.items())
+    chunksize = max(1, len(items) // (jobs * 4))
+    results = executor.map(verify_file_reasons, [path for path, _ in items],
+                           [rows for _, rows in items], chunksize=chunksize)
+    return items, results
+
+def collect_files(items, results):
+    # the results are written back into the parent's rows
+    for (_, rows), (reasons, summary) in zip(items, results):
+        instrumentation.merge(summary)
+        for row, reason in zip(rows, reasons):
+            row.verification_reason = reason
+            row.verification = reason is not None
+
+def init_worker(lib_path, cache_path=None, use_cache=None, profile_dir=None, use_mmap=False, rename_rules=None,
+                symbol_index_path=None):
+    # every worker gets its own tree-sitter parser, source cache and libclang setup
+    result_cache.configure(cache_path, use_cache)
+    profiling.configure_worker(profile_dir)
+    symbol_index.configure(symbol_index_path)
+    dwarf_functions.reset(use_mmap, rename_rules)
+    if lib_path is not None:
+        set_lib_path(lib_path)
+
+@profiling.profiled
+def verify_file_reasons(path, rows):
+    # the worker's timings and counters for this file go back with the reasons
+    instrumentation.reset()
+    verify_file(path, rows)
+    return [row.verification_reason for row in rows], instrumentation.summary()
+
+
+def pretty_print(srcinfo, src_path, jobs=1):
+    verify_functions(srcinfo, lambda row: combined_source_path(src_path, row.path), jobs)
+    print_report(srcinfo, jobs)
+
+def stream_print(cu_srcinfo, src_path, jobs=1, extracted=None):
+    # cu_srcinfo yields the functions of one CU at a time, like iter_srcinfo.
+    # Each CU is printed as soon as it is verified and then dropped, only the
+    # counts are kept, and (name, path, line, offset) in extracted if given.
+    # With jobs > 1 the workers verify one CU while the next one is decoded.
+    resolve_path = lambda row: combined_source_path(src_path, row.path)
+    counts = [0, 0]
+    executor = verify_executor(jobs) if jobs > 1 else None
+    pending = None
+    try:
+        for functions in cu_srcinfo:
+            if extracted is not None:
+                extracted.extend((row.name, row.path, row.line, row.offset) for row in functions)
+            if executor is None:
+                verify_functions(functions, resolve_path)
+                print_functions(functions, counts)
+                continue
+            files = {}
+            for row in functions:
+                files.setdefault(resolve_path(row), []).append(row)
+            submitted = submit_files(files, executor, jobs)
+            if pending is not None:
+                collect_files(*pending[1])
+                print_functions(pending[0], counts)
+            pending = (functions, submitted)
+        if pending is not None:
+            collect_files(*pending[1])
+            print_functions(pending[0], counts)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    count_functions, verifications = counts
+    print_metrics((verifications / count_functions) if verifications > 0 else 0, count_functions, count_functions-verifications)
+    print_cache_stats(jobs)
+
+def print_functions(functions, counts):
+    # the unverified functions of one CU, counts are [functions, verified]
+    for row in functions:
+        counts[0] += 1
+        if row.verification:
+            counts[1] += 1
+        else:
+            print("Not verified:", row.name, row.line, display_path(row.path))
+
+def display_path(path):
+    if '/usr/include' in path:
+        return path.replace('/usr/include', '~/scripts/include')
+    return path
+
+def print_report(srcinfo, jobs=1):
 
     table = PrettyTable()
     table.field_names = ["Function", "Line", "Path", "Reason"]
@@ -180,43 +273,27 @@ def pretty_print(srcinfo, src_path):
 
     functions_list = []
 
-
-
-
     for row in srcinfo:
-        combined_path = src_path + row.path
-        if row.path.startswith('../'):
-            combined_path = src_path + row.path.replace('../', '')
-
         count_functions += 1
-        '''
-        row.verification_reason = traverse_for_function(row)
-        print(row.verification_reason)
-
-        if row.verification_reason is None:
-            row.verification = True
-            verifications += 1
-
-        if row.verification is False:
-            table.add_row([row.name, row.line, row.path, row.verification_reason])
-        '''
-        if '/usr/include' in row.path:
-            row.path = row.path.replace('/usr/include', '~/scripts/include')
 
-        if tree_sitter_finding_bool(combined_path, row.name):
+        if row.verification:
             functions_list.append(row.name)
             verifications += 1
         else:
-            if defines_extension(combined_path, row.name):
-                functions_list.append(row.name)
-                verifications += 1
-            else:
-                table.add_row([row.name, row.line, row.path, ''])
+            table.add_row([row.name, row.line, display_path(row.path), ''])
 
 
     print(sorted(functions_list))
     print(table)
     print_metrics((verifications / count_functions) if verifications > 0 else 0, count_functions, count_functions-verifications)
+    print_cache_stats(jobs)
+
+def print_cache_stats(jobs=1):
+    if jobs <= 1:
+        print("Source cache:", dwarf_functions.source_cache.stats())
+    cache = result_cache.get_cache()
+    if cache is not None:
+        print("Result cache:", cache.stats())
 
 
     
@@ -262,24 +339,15 @@ def adjustment_for_fortify_functions(path, function_name):
             return True
     return False
 
-def tree_sitter_finding_bool(path, name):
-    #print_if(path, name)
-    return ts_get_function(get_code(path), name)
 
 def ts_get_function(code, function_name):
     #print("tree sitter finding function:", function_name)
-    tree = parser.parse(code.encode(encoding='utf-8'))
+    if isinstance(code, str):
+        code = code.encode('utf-8')
+    with instrumentation.stage("parser.parse"):
+        tree = dwarf_functions.parser.parse(code)
     #print_if(tree.root_node.__str__(), function_name)
-    #if CFunction(tree, function_name).function_node is not None:
-       # return CFunction(tree, function_name).function_node.text.decode('utf-8') == function_name
-    #else:
-        #print("tree sitter error:", function_name)
-        #return False
-    global function_names
-
-    find_function_names(tree.root_node)
-    function_names_tree = function_names
-    function_names = []
+    function_names_tree = function_names_in_tree(tree.root_node)
     #print(function_names_tree)
     #for x in function_names_tree:
         #print("ArrayList:", x, "Function_Name:", function_name)
@@ -290,65 +358,19 @@ def ts_get_function(code, function_name):
             return True
         return False
 
+@instrumentation.timed("get_code")
 def get_code(path):
-    with open(path, 'r') as file:
+    # bytes, tree-sitter and the regexes below take them without decoding
+    with open(path, 'rb') as file:
         code = file.read()
+    instrumentation.count("bytes_read", len(code))
     return code
 
+@instrumentation.timed("_gl_check")
 def _gl_check(code, function_name):
-    lines = code.splitlines()
-    for i, line in enumerate(lines):
-        if '_GL_' in line:
-            if function_name in lines[i + 1]:
-                return True
-    return False
-
-def find_function_names(node):
-    #print("Searching for function names in tree...node", str(node.type))
-    if str(node.type) == 'function_declarator' or str(node.type) == 'function_declaration':
-        #print("Found function declarator")
-        for child in node.named_children:
-            #print(str(child.type))
-            if str(child.type) == 'identifier':
-                #print(child.text.decode('utf-8'))
-                function_names.append(child.text.decode('utf-8'))
-    for child in node.named_children:
-        find_function_names(child)
-
-    return function_names
-
-
-
-def defines_extension(path, name):
-    #print("defines_extension for: ",name," and ", path)
-    code = get_code(path)
-    for line in code.splitlines():
-        match = re.match(r"#\s*define\s+(\S+)\s+" + name, line)
-        if match:
-            #print("New name: " + match.group(1).strip())
-            return tree_sitter_finding_bool(path, match.group(1).strip())
-    if LIBPATH is None:
-        return tree_sitter_finding_bool(path, renaming(name))
-    else:
-        return renaming_preprocessor(path, name)
-
-def renaming(name):
-    prefixes = ["rpl_", "i_", "m_", "i", "m", "x"]
-    #print("Checking for renaming:", name)
-    for prefix in prefixes:
-        if name.startswith(prefix):
-            #print("renaming:", name.replace(prefix, ""))
-            return name.replace(prefix, "")
-    return name
-
-def renaming_preprocessor(path, name):
-    includes = ["~/scripts/include", "lib/*"]
-    aliases = find_macro_chain(path, name, includes)
-    for alias in aliases:
-        if tree_sitter_finding_bool(path, alias):
-            return True
-    else:
-        return False
+    # is the name on the line after a _GL_ macro, cached sources keep their
+    # DirectiveIndex instead of calling this
+    return function_name in DirectiveIndex(code).gl_identifiers
 
 
 def print_if(string, name):
@@ -356,6 +378,38 @@ def print_if(string, name):
         print(string)
 
 
-
 if __name__ == '__main__':
-    main(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4])
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("path")
+    arg_parser.add_argument("src_path")
+    arg_parser.add_argument("db")
+    arg_parser.add_argument("lib_path")
+    arg_parser.add_argument("--jobs", type=int, default=1, help="decode CUs and verify source files in N worker processes, forked so they share the DWARF sections the parent read")
+    arg_parser.add_argument("--dsn", help="archsrc database connection string")
+    arg_parser.add_argument("--db-snapshot", metavar="SQLITE", help="read the archsrc tables from a snapshot made with archsrc_snapshot.py")
+    arg_parser.add_argument("--stream", action="store_true", help="verify each CU as soon as it is decoded")
+    arg_parser.add_argument("--no-accel", action="store_true", help="always walk every DIE, ignore .debug_names / .gdb_index")
+    arg_parser.add_argument("--accel-check", action="store_true", help="compare the accelerator table lookup with the full walk")
+    arg_parser.add_argument("--cache", help="result cache file (default: $DWARFINFO_CACHE or ~/.cache/dwarfinfo/results.sqlite)")
+    arg_parser.add_argument("--no-cache", action="store_true", help="always extract and verify, do not read or write the result cache")
+    arg_parser.add_argument("--stats", metavar="JSON", help="write per-stage timings and counters to JSON")
+    arg_parser.add_argument("--profile", metavar="DIR", help="write cProfile .pstats and collapsed stacks of the run and its workers to a new run-<time> directory in DIR")
+    arg_parser.add_argument("--mmap", action="store_true", help="map source files of 1 MB and more into memory instead of reading them")
+    arg_parser.add_argument("--rename-rule", action="append", default=[], metavar="RULE",
+                            help="extra rename rule, prefix:STR, suffix:STR or regex:PATTERN=REPLACEMENT (repeatable)")
+    arg_parser.add_argument("--symbol-index", metavar="SQLITE", help="index from symbol_index.py build, functions defined anywhere in it count as verified")
+    args = arg_parser.parse_args()
+    archsrc_db.configure(args.dsn, new_snapshot=args.db_snapshot)
+    symbol_index.configure(args.symbol_index)
+    dwarf_functions.source_cache.use_mmap = args.mmap
+    dwarf_functions.rename_resolver = RenameResolver(DEFAULT_RULES + args.rename_rule)
+    result_cache.configure(args.cache, not args.no_cache)
+    profiling.configure(args.profile)
+    profiling.run("main", main, args.path, args.src_path, args.db, args.lib_path, args.jobs, args.stream,
+                  not args.no_accel, args.accel_check)
+    if args.profile:
+        profiling.print_merged()
+    if args.stats:
+        instrumentation.print_summary(instrumentation.summary())
+        instrumentation.write_summary(args.stats, instrumentation.summary(), binary=args.path)
+
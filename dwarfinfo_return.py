@@ -1,62 +1,18 @@
 # from collections import defaultdict
-import os, sys, re
+import sys, re
 from elftools.elf.elffile import ELFFile
 from prettytable import PrettyTable
-from tree_sitter import Parser, Language
-import tree_sitter_c as ts_c
-import psycopg
-import clang.cindex
-
-function_names = []
-LIBPATH = None
-
-
-def find_macro_chain(filename, target_name, include_dirs=None):
-
-    if include_dirs is None:
-        include_dirs = []
-
-    args = [f"-I{inc}" for inc in include_dirs]
-    index = clang.cindex.Index.create()
-    tu = index.parse(filename, args=args)
-
-    # check for defines
-    macro_map = {}
-    for cursor in tu.cursor.walk_preorder():
-        if cursor.kind == clang.cindex.CursorKind.MACRO_DEFINITION:
-            tokens = list(cursor.get_tokens())
-            if len(tokens) >= 3:
-                name = tokens[1].spelling
-                replacement = " ".join(tok.spelling for tok in tokens[2:])
-                macro_map[name] = replacement
-
-    # recursive alias find
-    result = []
-
-    def resolve_aliases(name):
-        for alias, real in macro_map.items():
-            if real == name and alias not in result:
-                result.append(alias)
-                resolve_aliases(alias)
-
-    resolve_aliases(target_name)
-    return result
-
-
-# tree-sitter global object
-C_LANGUAGE = Language(ts_c.language())
-parser = Parser(C_LANGUAGE)
-
-FUNCTION_QUERY= """
-(
-    ( function_definition
-        declarator: ( function_declarator
-            declarator: (identifier) @function_names (#eq? @function_names "{function_name}")
-        )
-        body: (compound_statement) @function.body
-    )
-)
-"""
+
+import archsrc_db
+import dwarf_functions
+import instrumentation
+import result_cache
+from accel_tables import load_accelerator_index
+from directives import DirectiveIndex
+from dwarf_functions import DwarfFunctionInfo, db_relpath, get_srcinfo_db, iter_srcinfo, get_cached_srcinfo, \
+    set_lib_path, verify_file
+from ts_functions import function_names_in_tree, function_definitions
+
 
 class Metrics:
     def __init__(self, functions, verified):
@@ -64,156 +20,129 @@ class Metrics:
         self.verified_count = verified
 
 class CFunction:
-    def __init__(self, tree, function_name):
-        function_query = C_LANGUAGE.query(FUNCTION_QUERY.format(function_name=function_name))
-        function_captures = function_query.captures(tree.root_node)
-
-        if function_captures:
-            self.function_node = function_captures['function_names'][0]
+    def __init__(self, tree, function_name, definitions=None):
+        # pass the function_definitions(tree) map when looking up many names
+        if definitions is None:
+            definitions = function_definitions(tree)
+        definition = definitions.get(function_name)
+
+        if definition is not None:
+            self.function_node = definition.node
+            self.body_range = definition.body_range
+            self.start_line = definition.start_line
         else:
             #print("Tree sitter CFunction error for:", function_name)
             self.function_node = None
+            self.body_range = None
+            self.start_line = None
+
 
+@instrumentation.timed("get_srcinfo_db_batch")
+def get_srcinfo_db_batch(paths):
+    # one round trip for all paths, path -> [DwarfFunctionInfo, ...]
+    rows_by_relpath = archsrc_db.fetch_functions_batch([db_relpath(path) for path in paths])
+    srcinfo = {}
+    for path in paths:
+        srcinfo[path] = [DwarfFunctionInfo(*row) for row in rows_by_relpath[db_relpath(path)]]
+    return srcinfo
 
-class DwarfFunctionInfo:
-    def __init__(self, name, path, line, offset):
-        self.name = name
-        self.path = path
-        self.line = line
-        self.offset = offset
-        self.verification = False
-        self.verification_reason = None
-
-def get_srcinfo_db(path):
-    # DB Conn
-    conn = psycopg.connect(
-        dbname="archsrc",
-        user="rouser",
-        password="",
-        host="kuria",
-        port="5432"
-    )
-
-    query = """SELECT name, srcabspath, srcline, vaddr
-               FROM binary_functions
-               WHERE binary_id = (SELECT binary_id
-                   FROM binaries
-               WHERE compileopt = '00000' and relpath = 'usr/{path}');""".format(path=path)
-    function_container = []
-    with conn.cursor() as cur:
-        cur.execute(query)
-        rows = cur.fetchall()
-        for row in rows:
-            print(row[0][0], row[1], row[3])
-            if row[1] != None:
-                function_container.append(DwarfFunctionInfo(row[0][0], row[1], row[2], row[3]))
-
-    conn.close()
-    return function_container
-
-def get_srcinfo(dwarf):
-    function_container = []
-    # srcinfo = defaultdict(list)
-    for CU in dwarf.iter_CUs():
-        lineprog = dwarf.line_program_for_CU(CU)
-        file_entries = lineprog.header['file_entry']
-        dir_entries = lineprog.header['include_directory']
-        file_table, dir_table = dict(), dict()
-        #funcnames = set()
-        for i, entry in enumerate(file_entries):
-            file_table[i] = (entry.dir_index, entry.name.decode('latin-1'))
-        for i, entry in enumerate(dir_entries):
-            dir_table[i] = entry.decode('latin-1')
-        try:
-            for DIE in CU.iter_DIEs():
-                if DIE.tag == 'DW_TAG_subprogram':
-                    name = DIE.attributes['DW_AT_name'].value.decode('latin-1')
-                    file_idx = DIE.attributes['DW_AT_decl_file'].value
-                    dir_idx, file_name = file_table[file_idx]
-                    dir_name = dir_table[dir_idx]
-                    line = DIE.attributes['DW_AT_decl_line'].value
-                    path = os.path.join(dir_name, file_name)
-                    try:
-                        declaration = DIE.attributes['DW_AT_declaration'].value
-                    except KeyError:
-                        declaration = False
-                    if declaration:
-                        continue
-                    try:
-                        offset = DIE.attributes['DW_AT_low_pc'].value
-                    except KeyError:
-                        offset = 0
-
-                    function_container.append(DwarfFunctionInfo(name, path, line, offset))
-
-        except KeyError:
-            continue
-    return function_container
 
 def main(path, src_path, db, lib_path):
+    count_functions, verifications, error = main_sources(path, [src_path], db, lib_path)[0]
+    if error is not None:
+        raise error
+    return [count_functions, verifications]
+
+
+def main_sources(path, src_paths, db, lib_path, srcinfo=None):
+    # fetch the binary's functions once and verify them against every source file,
+    # srcinfo can be passed in when it was already fetched with get_srcinfo_db_batch.
+    # Returns [functions, verified, error] per source file, error is the exception
+    # a source file failed with, the others are still counted.
 
     # lib path
     # like ("/usr/lib/llvm-VERSION/lib/libclang.so")
     if lib_path != "":
-        global LIBPATH
-        LIBPATH = lib_path
-        clang.cindex.Config.set_library_file(lib_path)
+        set_lib_path(lib_path)
 
     print("Starting script for " + path + " ...")
     # check for DWARF information
-    srcinfo = None
-    if db:
+    cache = None
+    if srcinfo is not None:
+        pass
+    elif db:
         srcinfo = get_srcinfo_db(path)
     else:
+        # same build-id, same functions
+        cache = result_cache.get_cache()
+        if cache is not None:
+            cache_key = result_cache.binary_key(path)
+            srcinfo = get_cached_srcinfo(cache, cache_key)
+    if srcinfo is None:
         with open(path, 'rb') as fo:
             elffile = ELFFile(fo)
             if elffile.has_dwarf_info():
                 dwarfinfo = elffile.get_dwarf_info()
-                srcinfo = get_srcinfo(dwarfinfo)
-    metrics = pretty_print(srcinfo, src_path)
+                # only the counts are kept, so verify CU by CU while decoding
+                metrics = [[0, 0, None] for _ in src_paths]
+                extracted = []
+                for functions in iter_srcinfo(dwarfinfo, load_accelerator_index(elffile)):
+                    if cache is not None:
+                        extracted.extend((row.name, row.path, row.line, row.offset) for row in functions)
+                    for metric, src_path in zip(metrics, src_paths):
+                        if metric[2] is None:
+                            add_source_metric(metric, functions, src_path)
+                if cache is not None:
+                    cache.put_srcinfo(cache_key, extracted)
+                return metrics
+    metrics = [[0, 0, None] for _ in src_paths]
+    for metric, src_path in zip(metrics, src_paths):
+        add_source_metric(metric, srcinfo, src_path)
     return metrics
 
+def add_source_metric(metric, srcinfo, src_path):
+    # a source file that cannot be read or parsed only fails its own row
+    try:
+        count_functions, verifications = pretty_print(srcinfo, src_path)
+    except Exception as e:
+        metric[2] = e
+        return
+    metric[0] += count_functions
+    metric[1] += verifications
 
 
 def determine_compiler():
     return ".c"
 
-def pretty_print(srcinfo, src_path):
+def verify_functions(srcinfo, resolve_path):
+    # bucket the functions by source file so every file is indexed once,
+    # the rows keep their original order in srcinfo
+    files = {}
+    for row in srcinfo:
+        files.setdefault(resolve_path(row), []).append(row)
+    for path, rows in files.items():
+        verify_file(path, rows)
+    return files
 
 
+def pretty_print(srcinfo, src_path):
 
     count_functions = 0
     verifications = 0
 
     functions_list = []
 
-
-
+    # run_dwarfinfo passes the source file itself as src_path
+    verify_functions(srcinfo, lambda row: src_path)
 
     for row in srcinfo:
-
         count_functions += 1
-        '''
-        row.verification_reason = traverse_for_function(row)
-        print(row.verification_reason)
-
-        if row.verification_reason is None:
-            row.verification = True
-            verifications += 1
-
-        if row.verification is False:
-            table.add_row([row.name, row.line, row.path, row.verification_reason])
-        '''
         if '/usr/include' in row.path:
             row.path = row.path.replace('/usr/include', '~/scripts/include')
 
-        if tree_sitter_finding_bool(src_path, row.name):
+        if row.verification:
             functions_list.append(row.name)
             verifications += 1
-        else:
-            if defines_extension(src_path, row.name):
-                functions_list.append(row.name)
-                verifications += 1
 
     return [count_functions, verifications]
 
@@ -260,24 +189,15 @@ def adjustment_for_fortify_functions(path, function_name):
             return True
     return False
 
-def tree_sitter_finding_bool(path, name):
-    #print_if(path, name)
-    return ts_get_function(get_code(path), name)
 
 def ts_get_function(code, function_name):
     #print("tree sitter finding function:", function_name)
-    tree = parser.parse(code.encode(encoding='utf-8'))
+    if isinstance(code, str):
+        code = code.encode('utf-8')
+    with instrumentation.stage("parser.parse"):
+        tree = dwarf_functions.parser.parse(code)
     #print_if(tree.root_node.__str__(), function_name)
-    #if CFunction(tree, function_name).function_node is not None:
-       # return CFunction(tree, function_name).function_node.text.decode('utf-8') == function_name
-    #else:
-        #print("tree sitter error:", function_name)
-        #return False
-    global function_names
-
-    find_function_names(tree.root_node)
-    function_names_tree = function_names
-    function_names = []
+    function_names_tree = function_names_in_tree(tree.root_node)
     #print(function_names_tree)
     #for x in function_names_tree:
         #print("ArrayList:", x, "Function_Name:", function_name)
@@ -288,72 +208,24 @@ def ts_get_function(code, function_name):
             return True
         return False
 
+@instrumentation.timed("get_code")
 def get_code(path):
-    with open(path, 'r') as file:
+    # bytes, tree-sitter and the regexes below take them without decoding
+    with open(path, 'rb') as file:
         code = file.read()
+    instrumentation.count("bytes_read", len(code))
     return code
 
+@instrumentation.timed("_gl_check")
 def _gl_check(code, function_name):
-    lines = code.splitlines()
-    for i, line in enumerate(lines):
-        if '_GL_' in line:
-            if function_name in lines[i + 1]:
-                return True
-    return False
-
-def find_function_names(node):
-    #print("Searching for function names in tree...node", str(node.type))
-    if str(node.type) == 'function_declarator' or str(node.type) == 'function_declaration':
-        #print("Found function declarator")
-        for child in node.named_children:
-            #print(str(child.type))
-            if str(child.type) == 'identifier':
-                #print(child.text.decode('utf-8'))
-                function_names.append(child.text.decode('utf-8'))
-    for child in node.named_children:
-        find_function_names(child)
-
-    return function_names
-
-
-
-def defines_extension(path, name):
-    #print("defines_extension for: ",name," and ", path)
-    code = get_code(path)
-    for line in code.splitlines():
-        match = re.match(r"#\s*define\s+(\S+)\s+" + name, line)
-        if match:
-            #print("New name: " + match.group(1).strip())
-            return tree_sitter_finding_bool(path, match.group(1).strip())
-    if LIBPATH is None:
-        return tree_sitter_finding_bool(path, renaming(name))
-    else:
-        return renaming_preprocessor(path, name)
-
-def renaming(name):
-    prefixes = ["rpl_", "i_", "m_", "i", "m", "x"]
-    #print("Checking for renaming:", name)
-    for prefix in prefixes:
-        if name.startswith(prefix):
-            #print("renaming:", name.replace(prefix, ""))
-            return name.replace(prefix, "")
-    return name
-
-def renaming_preprocessor(path, name):
-    includes = ["~/scripts/include", "lib/*"]
-    aliases = find_macro_chain(path, name, includes)
-    for alias in aliases:
-        if tree_sitter_finding_bool(path, alias):
-            return True
-    else:
-        return False
-
+    # is the name on the line after a _GL_ macro, cached sources keep their
+    # DirectiveIndex instead of calling this
+    return function_name in DirectiveIndex(code).gl_identifiers
 
 def print_if(string, name):
     if name == "fseeko":
         print(string)
 
 
-
 if __name__ == '__main__':
     main(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4])
@@ -0,0 +1,102 @@
+import functools
+import json
+import time
+from contextlib import contextmanager
+
+from prettytable import PrettyTable
+
+
+class Stats:
+    # wall time and calls per stage plus plain counters (bytes read, verification
+    # paths, ...), stage times are inclusive of the stages they call
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.seconds = {}
+        self.calls = {}
+        self.counters = {}
+
+    def add(self, stage, seconds, calls=1):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+        self.calls[stage] = self.calls.get(stage, 0) + calls
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self):
+        return {
+            "stages": {stage: {"seconds": self.seconds[stage], "calls": self.calls[stage]} for stage in self.seconds},
+            "counters": dict(self.counters),
+        }
+
+    def merge(self, summary):
+        # adds a summary from a worker process
+        for stage, values in summary["stages"].items():
+            self.add(stage, values["seconds"], values["calls"])
+        for name, n in summary["counters"].items():
+            self.count(name, n)
+
+
+stats = Stats()
+
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.add(name, time.perf_counter() - start)
+
+
+def timed(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stats.add(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def count(name, n=1):
+    stats.count(name, n)
+
+
+def reset():
+    stats.reset()
+
+
+def summary():
+    return stats.summary()
+
+
+def merge(summary):
+    stats.merge(summary)
+
+
+def write_summary(path, summary, **extra):
+    with open(path, 'w') as file:
+        json.dump(dict(extra, **summary), file, indent=2)
+
+
+def print_summary(summary):
+    table = PrettyTable()
+    table.field_names = ["Stage", "Calls", "Seconds", "us/call"]
+    table.align = "r"
+    table.align["Stage"] = "l"
+    for name, values in sorted(summary["stages"].items(), key=lambda item: item[1]["seconds"], reverse=True):
+        table.add_row([name, values["calls"], "%.3f" % values["seconds"],
+                       "%.1f" % (values["seconds"] / values["calls"] * 1e6 if values["calls"] else 0)])
+    print(table)
+    counters = PrettyTable()
+    counters.field_names = ["Counter", "Value"]
+    counters.align = "r"
+    counters.align["Counter"] = "l"
+    for name, value in sorted(summary["counters"].items()):
+        counters.add_row([name, value])
+    print(counters)
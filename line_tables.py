@@ -0,0 +1,156 @@
+import os
+import weakref
+
+from die_scanner import read_uleb
+
+DW_LNCT_path = 1
+DW_LNCT_directory_index = 2
+
+DW_FORM_block = 0x09
+DW_FORM_string = 0x08
+DW_FORM_strp = 0x0e
+DW_FORM_udata = 0x0f
+DW_FORM_line_strp = 0x1f
+DW_FORM_data16 = 0x1e
+FIXED_FORMS = {0x0b: 1, 0x05: 2, 0x06: 4, 0x07: 8, DW_FORM_data16: 16}
+
+
+class LineTableReader:
+    # reads only the header of a line program: the directory and file tables.
+    # The resolved file index -> path map is cached per DW_AT_stmt_list offset,
+    # so CUs sharing a line table decode it once.
+    def __init__(self, dwarf):
+        self.dwarf = dwarf
+        self.debug_line = dwarf.debug_line_sec.stream.getvalue() if dwarf.debug_line_sec else b''
+        self.debug_str = dwarf.debug_str_sec.stream.getvalue() if dwarf.debug_str_sec else b''
+        line_str_sec = getattr(dwarf, 'debug_line_str_sec', None)
+        self.debug_line_str = line_str_sec.stream.getvalue() if line_str_sec else b''
+        self.byteorder = 'little' if dwarf.config.little_endian else 'big'
+        self.tables = {}
+
+    def file_paths(self, CU):
+        top_DIE = CU.get_top_DIE()
+        if 'DW_AT_stmt_list' not in top_DIE.attributes:
+            return {}
+        offset = top_DIE.attributes['DW_AT_stmt_list'].value
+        comp_dir = top_DIE.attributes['DW_AT_comp_dir'].value if 'DW_AT_comp_dir' in top_DIE.attributes else b''
+        # before DWARF 5, directory 0 is the CU's compilation directory
+        key = (offset, comp_dir)
+        paths = self.tables.get(key)
+        if paths is None:
+            try:
+                paths = self.read_file_paths(offset, comp_dir.decode('latin-1'))
+            except (ValueError, IndexError):
+                paths = self.lineprog_file_paths(CU, comp_dir.decode('latin-1'))
+            self.tables[key] = paths
+        return paths
+
+    def lineprog_file_paths(self, CU, comp_dir):
+        # full pyelftools line program, for headers read_file_paths cannot handle
+        header = self.dwarf.line_program_for_CU(CU).header
+        dirs = [entry.decode('latin-1') for entry in header['include_directory']]
+        first_file = 0
+        if header['version'] < 5:
+            dirs.insert(0, comp_dir)
+            first_file = 1
+        paths = {}
+        for i, entry in enumerate(header['file_entry'], first_file):
+            if entry.dir_index < len(dirs):
+                paths[i] = os.path.join(dirs[entry.dir_index], entry.name.decode('latin-1'))
+        return paths
+
+    def read_int(self, pos, size):
+        return int.from_bytes(self.debug_line[pos:pos + size], self.byteorder), pos + size
+
+    def read_cstring(self, pos):
+        end = self.debug_line.index(b'\0', pos)
+        return self.debug_line[pos:end].decode('latin-1'), end + 1
+
+    def read_file_paths(self, offset, comp_dir):
+        pos = offset
+        unit_length, pos = self.read_int(pos, 4)
+        offset_size = 4
+        if unit_length == 0xffffffff:
+            offset_size = 8
+            pos += 8
+        version, pos = self.read_int(pos, 2)
+        if version >= 5:
+            pos += 2  # address_size, segment_selector_size
+        pos += offset_size  # header_length
+        pos += 1  # minimum_instruction_length
+        if version >= 4:
+            pos += 1  # maximum_operations_per_instruction
+        pos += 3  # default_is_stmt, line_base, line_range
+        opcode_base = self.debug_line[pos]
+        pos += opcode_base  # opcode_base and standard_opcode_lengths
+
+        if version >= 5:
+            directories, pos = self.read_entries(pos, offset_size)
+            files, pos = self.read_entries(pos, offset_size)
+            dirs = [entry.get(DW_LNCT_path, '') for entry in directories]
+            files = [(entry.get(DW_LNCT_directory_index, 0), entry.get(DW_LNCT_path, '')) for entry in files]
+            first_file = 0
+        else:
+            dirs = [comp_dir]
+            while self.debug_line[pos] != 0:
+                directory, pos = self.read_cstring(pos)
+                dirs.append(directory)
+            pos += 1
+            files = []
+            while self.debug_line[pos] != 0:
+                name, pos = self.read_cstring(pos)
+                dir_index, pos = read_uleb(self.debug_line, pos)
+                _, pos = read_uleb(self.debug_line, pos)  # mtime
+                _, pos = read_uleb(self.debug_line, pos)  # length
+                files.append((dir_index, name))
+            first_file = 1
+
+        paths = {}
+        for i, (dir_index, name) in enumerate(files, first_file):
+            if dir_index < len(dirs):
+                paths[i] = os.path.join(dirs[dir_index], name)
+        return paths
+
+    def read_entries(self, pos, offset_size):
+        # DWARF 5 directory / file name table with its entry format description
+        format_count = self.debug_line[pos]
+        pos += 1
+        entry_format = []
+        for _ in range(format_count):
+            content_type, pos = read_uleb(self.debug_line, pos)
+            form, pos = read_uleb(self.debug_line, pos)
+            entry_format.append((content_type, form))
+        count, pos = read_uleb(self.debug_line, pos)
+        entries = []
+        for _ in range(count):
+            entry = {}
+            for content_type, form in entry_format:
+                if form == DW_FORM_string:
+                    value, pos = self.read_cstring(pos)
+                elif form == DW_FORM_line_strp or form == DW_FORM_strp:
+                    section = self.debug_line_str if form == DW_FORM_line_strp else self.debug_str
+                    string_offset, pos = self.read_int(pos, offset_size)
+                    value = section[string_offset:section.index(b'\0', string_offset)].decode('latin-1')
+                elif form == DW_FORM_udata:
+                    value, pos = read_uleb(self.debug_line, pos)
+                elif form in FIXED_FORMS:
+                    value, pos = self.read_int(pos, FIXED_FORMS[form])
+                elif form == DW_FORM_block:
+                    length, pos = read_uleb(self.debug_line, pos)
+                    value, pos = None, pos + length
+                else:
+                    raise ValueError("unsupported line table form 0x%x" % form)
+                entry[content_type] = value
+            entries.append(entry)
+        return entries, pos
+
+
+_readers = weakref.WeakKeyDictionary()
+
+
+def line_table_paths(dwarf, CU):
+    # file index -> path for the CU's line table
+    reader = _readers.get(dwarf)
+    if reader is None:
+        reader = _readers[dwarf] = LineTableReader(dwarf)
+    return reader.file_paths(CU)
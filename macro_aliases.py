@@ -0,0 +1,90 @@
+import os
+from collections import OrderedDict
+
+import clang.cindex
+
+import instrumentation
+
+# macros only show up as cursors with the detailed preprocessing record,
+# function bodies never contain #defines that matter here
+PARSE_OPTIONS = (clang.cindex.TranslationUnit.PARSE_DETAILED_PROCESSING_RECORD
+                 | clang.cindex.TranslationUnit.PARSE_SKIP_FUNCTION_BODIES)
+# translation units kept, the least recently used alias graph goes first
+MAX_ENTRIES = 256
+
+
+class MacroAliasIndex:
+    # reverse alias graph of one translation unit: replacement -> macro names
+    def __init__(self, macro_map):
+        self.aliases = {}
+        for name, replacement in macro_map.items():
+            self.aliases.setdefault(replacement, []).append(name)
+        self.chains = {}
+
+    def alias_chain(self, target_name):
+        chain = self.chains.get(target_name)
+        if chain is None:
+            chain = self.resolve_aliases(target_name)
+            self.chains[target_name] = chain
+        return list(chain)
+
+    def resolve_aliases(self, target_name):
+        # same order as the old recursive resolve_aliases, without the
+        # scan over the whole macro map per step
+        result = []
+        seen = set()
+        stack = [iter(self.aliases.get(target_name, ()))]
+        while stack:
+            for alias in stack[-1]:
+                if alias not in seen:
+                    seen.add(alias)
+                    result.append(alias)
+                    stack.append(iter(self.aliases.get(alias, ())))
+                    break
+            else:
+                stack.pop()
+        return tuple(result)
+
+
+class MacroAliasCache:
+    # one translation unit parse per (file, include dirs, clang args)
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.index = None
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.parses = 0
+        self.hits = 0
+        self.evictions = 0
+
+    def get(self, filename, include_dirs=(), args=()):
+        stat = os.stat(filename)
+        key = (filename, stat.st_mtime_ns, tuple(include_dirs), tuple(args))
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry
+
+        entry = MacroAliasIndex(self.parse_macros(filename, include_dirs, args))
+        self.entries[key] = entry
+        while len(self.entries) > max(self.max_entries, 1):
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+    def parse_macros(self, filename, include_dirs, args):
+        # created lazily, main() may still have to set the libclang path
+        if self.index is None:
+            self.index = clang.cindex.Index.create()
+        self.parses += 1
+        clang_args = [f"-I{inc}" for inc in include_dirs] + list(args)
+        with instrumentation.stage("libclang.parse"):
+            tu = self.index.parse(filename, args=clang_args, options=PARSE_OPTIONS)
+
+        macro_map = {}
+        for cursor in tu.cursor.get_children():
+            if cursor.kind == clang.cindex.CursorKind.MACRO_DEFINITION:
+                tokens = list(cursor.get_tokens())
+                if len(tokens) >= 2:
+                    macro_map[cursor.spelling] = " ".join(tok.spelling for tok in tokens[1:])
+        return macro_map
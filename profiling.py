@@ -0,0 +1,170 @@
+import cProfile
+import functools
+import glob
+import multiprocessing.util
+import os
+import pstats
+import sys
+import time
+
+# directory of this run's .pstats files, a fresh one below the --profile
+# directory per run, None if profiling is off
+directory = None
+
+AGGREGATE = "aggregate"
+# collapsed stacks below this many microseconds are dropped
+MIN_STACK_US = 1
+MAX_DEPTH = 200
+
+# the profiler of a worker process, shared by all its profiled calls
+_worker_profiler = None
+_worker_pid = None
+
+
+def configure(new_directory):
+    # a new run directory, so merge() never picks up the profiles of an earlier run
+    global directory
+    directory = None
+    if new_directory:
+        os.makedirs(new_directory, exist_ok=True)
+        directory = unique_path(os.path.join(new_directory, time.strftime("run-%Y%m%d-%H%M%S")), "")
+        os.mkdir(directory)
+
+
+def configure_worker(run_directory):
+    # pool initializer, workers write into the run directory of their parent
+    global directory
+    directory = run_directory
+
+
+def unique_path(path, suffix):
+    # path, or path-2, path-3, ... if path + suffix is taken
+    candidate = path
+    n = 1
+    while os.path.exists(candidate + suffix):
+        n += 1
+        candidate = "%s-%d" % (path, n)
+    return candidate
+
+
+def run(name, function, *args, **kwargs):
+    # profiles one call, writes <name>.pstats and <name>.collapsed
+    if directory is None:
+        return function(*args, **kwargs)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args, **kwargs)
+    finally:
+        path = unique_path(os.path.join(directory, safe_name(name)), ".pstats")
+        profiler.dump_stats(path + ".pstats")
+        write_collapsed(pstats.Stats(path + ".pstats"), path + ".collapsed")
+
+
+def profiled(function):
+    # for tasks running in pool workers, all calls in one worker go into one
+    # profile, written to worker-<pid>.pstats when the worker exits
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if directory is None:
+            return function(*args, **kwargs)
+        profiler = worker_profiler()
+        # a forked worker inherits the parent's profiler
+        sys.setprofile(None)
+        profiler.enable()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profiler.disable()
+    return wrapper
+
+
+def worker_profiler():
+    global _worker_profiler, _worker_pid
+    if _worker_profiler is None or _worker_pid != os.getpid():
+        _worker_profiler = cProfile.Profile()
+        _worker_pid = os.getpid()
+        # pool workers leave through os._exit, atexit handlers do not run there,
+        # multiprocessing's finalizers do
+        multiprocessing.util.Finalize(None, dump_worker_profile, args=(_worker_profiler, directory), exitpriority=10)
+    return _worker_profiler
+
+
+def dump_worker_profile(profiler, run_directory):
+    path = unique_path(os.path.join(run_directory, "worker-%d" % os.getpid()), ".pstats")
+    profiler.dump_stats(path + ".pstats")
+
+
+def safe_name(name):
+    return "".join(c if c.isalnum() or c in "-_." else "_" for c in name)
+
+
+def merge():
+    # every .pstats file of this run -> aggregate.pstats / aggregate.collapsed
+    paths = [path for path in sorted(glob.glob(os.path.join(directory, "*.pstats")))
+             if os.path.basename(path) != AGGREGATE + ".pstats"]
+    if not paths:
+        return None
+    stats = pstats.Stats(*paths)
+    path = os.path.join(directory, AGGREGATE)
+    stats.dump_stats(path + ".pstats")
+    write_collapsed(stats, path + ".collapsed")
+    return path
+
+
+def print_merged():
+    # merge() has nothing to write if no package got as far as being profiled
+    path = merge()
+    if path is None:
+        print("No profiles in", directory)
+    else:
+        print("Profile written to", path + ".pstats")
+
+
+def label(function):
+    filename, line, name = function
+    if filename == '~':
+        return name.replace(';', ':')
+    return ("%s (%s:%d)" % (name, os.path.basename(filename), line)).replace(';', ':')
+
+
+def collapsed_stacks(stats):
+    # cProfile only keeps caller -> callee pairs, not whole stacks. The stacks
+    # are rebuilt from the roots down, each callee's time on a path is its share
+    # of the time it spent being called from the function above it.
+    children = {}
+    roots = []
+    for function, (_, _, _, _, callers) in stats.stats.items():
+        if not callers:
+            roots.append(function)
+        for caller in callers:
+            children.setdefault(caller, []).append(function)
+
+    stacks = {}
+
+    def walk(function, path, seconds, depth):
+        _, _, self_time, total_time, _ = stats.stats[function]
+        if total_time <= 0 or depth > MAX_DEPTH:
+            return
+        path = path + (function,)
+        scale = seconds / total_time
+        us = int(self_time * scale * 1e6)
+        if us >= MIN_STACK_US:
+            stack = ";".join(label(f) for f in path)
+            stacks[stack] = stacks.get(stack, 0) + us
+        for callee in children.get(function, ()):
+            if callee in path:
+                continue
+            callee_seconds = stats.stats[callee][4][function][3] * scale
+            if callee_seconds * 1e6 >= MIN_STACK_US:
+                walk(callee, path, callee_seconds, depth + 1)
+
+    for root in roots:
+        walk(root, (), stats.stats[root][3], 0)
+    return stacks
+
+
+def write_collapsed(stats, path):
+    # "frame;frame;frame microseconds" lines, what flamegraph.pl and speedscope read
+    with open(path, 'w') as file:
+        for stack, us in sorted(collapsed_stacks(stats).items()):
+            file.write("%s %d\n" % (stack, us))
@@ -0,0 +1,74 @@
+import hashlib
+import re
+
+# how a compiled name can differ from the name in the source: gnulib rpl_
+# replacements, i_/m_ wrappers, x* allocators and the _unlocked / 64 variants
+# of stdio and LFS functions. "kind:argument", a regex is "regex:pattern=replacement".
+DEFAULT_RULES = [
+    "prefix:rpl_", "prefix:i_", "prefix:m_", "prefix:i", "prefix:m", "prefix:x",
+    "suffix:_unlocked", "suffix:64",
+]
+
+
+class RenameRule:
+    def __init__(self, spec):
+        self.spec = spec
+        kind, _, argument = spec.partition(":")
+        self.kind = kind
+        if kind == "prefix" or kind == "suffix":
+            if not argument:
+                raise ValueError("empty rename rule %r" % spec)
+            self.affix = argument
+        elif kind == "regex":
+            pattern, _, self.replacement = argument.partition("=")
+            self.pattern = re.compile(pattern)
+        else:
+            raise ValueError("unknown rename rule %r, expected prefix:, suffix: or regex:" % spec)
+
+    def apply(self, name):
+        # the source name this rule turns name back into, None if it does not apply
+        if self.kind == "prefix":
+            if name.startswith(self.affix) and len(name) > len(self.affix):
+                return name[len(self.affix):]
+        elif self.kind == "suffix":
+            if name.endswith(self.affix) and len(name) > len(self.affix):
+                return name[:-len(self.affix)]
+        else:
+            candidate, count = self.pattern.subn(self.replacement, name, count=1)
+            if count and candidate and candidate != name:
+                return candidate
+        return None
+
+
+class RenameResolver:
+    def __init__(self, specs=DEFAULT_RULES):
+        self.rules = [RenameRule(spec) for spec in specs]
+
+    def digest(self):
+        # identifies the rule set in cache keys, the order matters as the first rule wins
+        return hashlib.sha1("\n".join(rule.spec for rule in self.rules).encode('utf-8')).hexdigest()[:16]
+
+    def candidates(self, name):
+        # candidate -> rule, every single rule and every prefix rule followed by
+        # another rule (rpl_fopen64 -> fopen), the first rule that gives a name wins
+        candidates = {}
+        for rule in self.rules:
+            candidate = rule.apply(name)
+            if candidate is None or candidate in candidates:
+                continue
+            candidates[candidate] = rule.spec
+            if rule.kind == "prefix":
+                for second in self.rules:
+                    if second.kind != "prefix":
+                        stripped = second.apply(candidate)
+                        if stripped is not None and stripped not in candidates:
+                            candidates[stripped] = rule.spec + "+" + second.spec
+        return candidates
+
+    def resolve(self, name, *name_sets):
+        # (source name, rule) of the first candidate in any of name_sets, or None
+        for candidate, rule in self.candidates(name).items():
+            for names in name_sets:
+                if candidate in names:
+                    return candidate, rule
+        return None
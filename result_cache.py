@@ -0,0 +1,217 @@
+import atexit
+import hashlib
+import json
+import multiprocessing.util
+import os
+import sqlite3
+import time
+import zlib
+from collections import OrderedDict
+
+from elftools.elf.elffile import ELFFile
+from elftools.elf.sections import NoteSection
+
+# bump when extraction or verification changes, old entries are then ignored
+CACHE_VERSION = 3
+
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".cache", "dwarfinfo", "results.sqlite")
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+# cache hits only mark rows as used in the next write, or after this many hits
+TOUCH_BATCH = 1000
+# source hashes kept per process, keyed by (path, mtime, size)
+MAX_SOURCE_HASHES = 4096
+
+path = os.environ.get("DWARFINFO_CACHE", DEFAULT_PATH)
+enabled = True
+max_bytes = DEFAULT_MAX_BYTES
+_cache = None
+_cache_pid = None
+_source_hashes = OrderedDict()
+
+
+def configure(new_path=None, use_cache=None, new_max_bytes=None):
+    global path, enabled, max_bytes
+    if new_path is not None:
+        path = new_path
+    if use_cache is not None:
+        enabled = use_cache
+    if new_max_bytes is not None:
+        max_bytes = new_max_bytes
+    close()
+
+
+def get_cache():
+    # one connection per process, None with --no-cache
+    global _cache, _cache_pid
+    if not enabled:
+        return None
+    if _cache is None or _cache_pid != os.getpid():
+        _cache = ResultCache(path, max_bytes)
+        _cache_pid = os.getpid()
+        # pool workers leave through os._exit and skip the atexit handler below,
+        # multiprocessing's finalizers still write their last hits
+        multiprocessing.util.Finalize(None, close, exitpriority=10)
+    return _cache
+
+
+def close():
+    global _cache, _cache_pid
+    if _cache is not None and _cache_pid == os.getpid():
+        _cache.close()
+    _cache = None
+    _cache_pid = None
+
+
+# the last hits of a run are written when the process exits
+atexit.register(close)
+
+
+def binary_key(binary_path):
+    # the GNU build-id identifies the binary, hash the whole file without one
+    with open(binary_path, 'rb') as fo:
+        for section in ELFFile(fo).iter_sections():
+            if isinstance(section, NoteSection):
+                for note in section.iter_notes():
+                    if note['n_type'] == 'NT_GNU_BUILD_ID':
+                        return "build-id:" + note['n_desc']
+    return "sha256:" + file_hash(binary_path)
+
+
+def file_hash(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def source_hash(file_path):
+    # file_hash of a source file, hashed once per run and not once per CU
+    stat = os.stat(file_path)
+    key = (file_path, stat.st_mtime_ns, stat.st_size)
+    digest = _source_hashes.get(key)
+    if digest is None:
+        digest = _source_hashes[key] = file_hash(file_path)
+        if len(_source_hashes) > MAX_SOURCE_HASHES:
+            _source_hashes.popitem(last=False)
+    else:
+        _source_hashes.move_to_end(key)
+    return digest
+
+
+class ResultCache:
+    # binary key -> extracted functions, (source hash, mode, function) -> verification reason
+    def __init__(self, db_path, max_bytes=DEFAULT_MAX_BYTES):
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.conn = sqlite3.connect(db_path, timeout=60)
+        self.conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS srcinfo (
+                                 binary_key TEXT PRIMARY KEY, functions BLOB, used REAL)""")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS verification (
+                                 source_hash TEXT, mode TEXT, name TEXT, reason TEXT, used REAL,
+                                 PRIMARY KEY (source_hash, mode, name))""")
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+        # binary keys and (source hash, mode) pairs that were read since the last write
+        self.touched_srcinfo = set()
+        self.touched_verifications = set()
+
+    def close(self):
+        self.touch()
+        self.conn.close()
+
+    def touch(self):
+        # one transaction for all the hits, a lookup does not write by itself so
+        # concurrent workers do not queue up on the database lock for every hit
+        if not self.touched_srcinfo and not self.touched_verifications:
+            return
+        now = time.time()
+        self.conn.executemany("UPDATE srcinfo SET used = ? WHERE binary_key = ?",
+                              [(now, key) for key in self.touched_srcinfo])
+        self.conn.executemany("UPDATE verification SET used = ? WHERE source_hash = ? AND mode = ?",
+                              [(now, source_hash, mode) for source_hash, mode in self.touched_verifications])
+        self.conn.commit()
+        self.touched_srcinfo.clear()
+        self.touched_verifications.clear()
+
+    def touched(self):
+        return len(self.touched_srcinfo) + len(self.touched_verifications)
+
+    def get_srcinfo(self, key):
+        # [(name, path, line, offset), ...] or None
+        key = "%d:%s" % (CACHE_VERSION, key)
+        row = self.conn.execute("SELECT functions FROM srcinfo WHERE binary_key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.touched_srcinfo.add(key)
+        if self.touched() >= TOUCH_BATCH:
+            self.touch()
+        return [tuple(function) for function in json.loads(zlib.decompress(row[0]))]
+
+    def put_srcinfo(self, key, functions):
+        key = "%d:%s" % (CACHE_VERSION, key)
+        blob = zlib.compress(json.dumps([list(function) for function in functions]).encode('utf-8'))
+        self.touch()
+        self.conn.execute("INSERT OR REPLACE INTO srcinfo VALUES (?, ?, ?)", (key, blob, time.time()))
+        self.conn.commit()
+        self.evict()
+
+    def get_verifications(self, source_hash, mode, names):
+        # name -> reason (None if it was not verified) for the names that are cached
+        mode = "%d:%s" % (CACHE_VERSION, mode)
+        results = {}
+        names = list(names)
+        # stay below SQLite's host parameter limit
+        for i in range(0, len(names), 500):
+            chunk = names[i:i + 500]
+            query = ("SELECT name, reason FROM verification WHERE source_hash = ? AND mode = ? AND name IN (%s)"
+                     % ", ".join("?" * len(chunk)))
+            for name, reason in self.conn.execute(query, [source_hash, mode] + chunk):
+                results[name] = reason
+        self.hits += len(results)
+        self.misses += len(set(names)) - len(results)
+        if results:
+            self.touched_verifications.add((source_hash, mode))
+            if self.touched() >= TOUCH_BATCH:
+                self.touch()
+        return results
+
+    def put_verifications(self, source_hash, mode, reasons):
+        mode = "%d:%s" % (CACHE_VERSION, mode)
+        self.touch()
+        now = time.time()
+        self.conn.executemany("INSERT OR REPLACE INTO verification VALUES (?, ?, ?, ?, ?)",
+                              [(source_hash, mode, name, reason, now) for name, reason in reasons.items()])
+        self.conn.commit()
+        self.evict()
+
+    def size(self):
+        page_count = self.conn.execute("PRAGMA page_count").fetchone()[0]
+        free_pages = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+        page_size = self.conn.execute("PRAGMA page_size").fetchone()[0]
+        return (page_count - free_pages) * page_size
+
+    def evict(self):
+        # drop the least recently used tenth of both tables until the file fits
+        while self.size() > self.max_bytes:
+            removed = 0
+            for table in ("srcinfo", "verification"):
+                count = self.conn.execute("SELECT count(*) FROM %s" % table).fetchone()[0]
+                if count:
+                    removed += self.conn.execute(
+                        "DELETE FROM %s WHERE rowid IN (SELECT rowid FROM %s ORDER BY used LIMIT ?)" % (table, table),
+                        (max(1, count // 10),)).rowcount
+            self.conn.commit()
+            if removed == 0:
+                break
+        self.conn.execute("PRAGMA incremental_vacuum")
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "bytes": self.size()}
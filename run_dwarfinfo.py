@@ -1,61 +1,245 @@
+import os
 import subprocess
 import csv
-import psycopg
+import io
+import json
 import sys
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 
+import archsrc_db
 import dwarfinfo_return
+import instrumentation
+import profiling
+import result_cache
+import symbol_index
 
 
 def get_package_info_db():
-    # DB Conn
-    conn = psycopg.connect(
-        dbname="archsrc",
-        user="rouser",
-        password="",
-        host="kuria",
-        port="5432"
-    )
-
-    query = """SELECT b.pkg, b.abspath, f.srcabspath
-               FROM binaries b JOIN binary_functions f on b.binary_id = f.binary_id
-               WHERE b.compileopt = '00000' and f.srcabspath like '/usr%'
-               ORDER BY b.pkg LIMIT 100;"""
+    # one row per (binary, source file) instead of one per function
     packackge_container = []
-    with conn.cursor() as cur:
-        cur.execute(query)
-        rows = cur.fetchall()
-        for row in rows:
-            if row[2] != None:
-                srcabspath = row[1].split("/usr")[0]+row[2]
-                packackge_container.append([row[0], row[1], srcabspath])
-
-    conn.close()
+    for row in archsrc_db.fetch_package_units(100):
+        if row[2] != None:
+            srcabspath = row[1].split("/usr")[0]+row[2]
+            packackge_container.append([row[0], row[1], srcabspath, row[3]])
     return packackge_container
 
-def main():
+def group_by_binary(packages):
+    # [pkg, abspath, [srcabspath, ...], function rows] per binary, so every
+    # binary's function list is fetched once and every source file verified once
+    binaries = {}
+    for pkg, abspath, srcabspath, functions in packages:
+        # the source paths are dict keys while grouping, in first seen order
+        binary = binaries.setdefault(abspath, [pkg, abspath, {}, 0])
+        binary[2][srcabspath] = None
+        binary[3] += functions
+    for binary in binaries.values():
+        binary[2] = list(binary[2])
+    return list(binaries.values())
+
+def print_work_units(packages, binaries):
+    function_rows = sum(package[3] for package in packages)
+    units = sum(len(binary[2]) for binary in binaries)
+    print(f"{function_rows} function rows -> {units} (binary, source file) units in {len(binaries)} binaries, "
+          f"{function_rows - units} duplicate verifications and {function_rows - len(binaries)} duplicate fetches removed")
+
+def schedule_packages(binaries):
+    # biggest binaries first, so a large package does not start last and
+    # leave the other workers idle at the end of the run
+    return sorted(binaries, key=lambda binary: binary[3], reverse=True)
+
+def read_finished(filename):
+    # (abspath, srcabspath) pairs an earlier run wrote, failed ones are run again
+    with open(filename, 'rb+') as csvfile:
+        data = csvfile.read()
+        # a row cut off by the crash is dropped and redone
+        end = data.rfind(b"\n") + 1
+        csvfile.truncate(end)
+    finished = set()
+    for row in csv.DictReader(io.StringIO(data[:end].decode('utf-8'), newline='')):
+        if not row.get("error"):
+            finished.add((row["abspath"], row["srcabspath"]))
+    return finished
+
+def skip_finished(binaries, finished):
+    remaining = []
+    for pkg, abspath, srcabspaths, functions in binaries:
+        srcabspaths = [src for src in srcabspaths if (abspath, src) not in finished]
+        if srcabspaths:
+            remaining.append([pkg, abspath, srcabspaths, functions])
+    return remaining
+
+def run_package(binary, srcinfo=None):
+    # (metrics, timings and counters of this package)
+    instrumentation.reset()
+    metrics = profiling.run(binary[0] + "-" + os.path.basename(binary[1]), dwarfinfo_return.main_sources,
+                            binary[1], binary[2], True, "", srcinfo)
+    return metrics, instrumentation.summary()
+
+def prefetch_srcinfo(binaries, batch_size):
+    # yields (binary, srcinfo), fetching the function lists of batch_size
+    # binaries in one query, or None to let every package fetch its own
+    for i in range(0, len(binaries), max(batch_size, 1)):
+        batch = binaries[i:i + batch_size]
+        srcinfo = dwarfinfo_return.get_srcinfo_db_batch([binary[1] for binary in batch]) if batch_size > 1 else {}
+        for binary in batch:
+            yield binary, srcinfo.get(binary[1])
+
+def init_worker(dsn, snapshot, cache_path, use_cache, profile_dir, symbol_index_path):
+    archsrc_db.configure(dsn, new_snapshot=snapshot or "")
+    symbol_index.configure(symbol_index_path)
+    result_cache.configure(cache_path, use_cache)
+    profiling.configure_worker(profile_dir)
+
+def run_packages(binaries, jobs, batch_size=1):
+    # yields (binary, (metrics, summary), error) in the order the binaries finish, a
+    # failing package is reported with its exception instead of ending the run
+    if jobs <= 1:
+        for binary, srcinfo in prefetch_srcinfo(binaries, batch_size):
+            try:
+                yield binary, run_package(binary, srcinfo), None
+            except Exception as e:
+                yield binary, None, e
+        return
+    work = prefetch_srcinfo(binaries, batch_size)
+    executor = new_executor(jobs)
+    try:
+        # at most jobs * 2 binaries in flight, the next one is submitted as one
+        # finishes, so the function lists of a batch are fetched as they are needed
+        futures = {}
+        resubmit = None
+        while True:
+            while len(futures) < jobs * 2:
+                item = resubmit or next(work, None)
+                resubmit = None
+                if item is None:
+                    break
+                try:
+                    futures[executor.submit(run_package, *item)] = item
+                except BrokenProcessPool:
+                    # never ran, it is submitted again once the pool is replaced
+                    resubmit = item
+                    if futures:
+                        break
+                    executor.shutdown()
+                    executor = new_executor(jobs)
+            if not futures:
+                break
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            if any(isinstance(future.exception(), BrokenProcessPool) for future in done):
+                # a worker died and the pool fails everything still in flight
+                # with it, finish the ones that completed before that
+                wait(futures)
+                done = list(futures)
+            broken = []
+            for future in done:
+                binary, srcinfo = futures.pop(future)
+                error = future.exception()
+                if isinstance(error, BrokenProcessPool):
+                    broken.append((binary, srcinfo))
+                else:
+                    yield binary, None if error else future.result(), error
+            if broken:
+                # which of them killed the worker is unknown, so they run again
+                # one at a time in a new pool. Only a binary that breaks the pool
+                # on its own is reported as failed, the others get no error row.
+                executor.shutdown()
+                executor = new_executor(jobs)
+                for binary, srcinfo in broken:
+                    future = executor.submit(run_package, binary, srcinfo)
+                    error = future.exception()
+                    if isinstance(error, BrokenProcessPool):
+                        executor.shutdown()
+                        executor = new_executor(jobs)
+                    yield binary, None if error else future.result(), error
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+def new_executor(jobs):
+    return ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                               initargs=(archsrc_db.dsn, archsrc_db.snapshot, result_cache.path, result_cache.enabled,
+                                         profiling.directory, symbol_index.path))
+
+def main(jobs=1, batch_size=500, resume=None):
     now = datetime.now()
     datum_str = now.strftime("%Y-%m-%d-%H_%M_%S")
-    filename = datum_str + ".csv"
+    filename = resume or datum_str + ".csv"
     packages = get_package_info_db()
-    metrics = []
-    for package in packages:
-        metric = dwarfinfo_return.main(package[1], package[2], True, "")
-        print("\nbin_path:",package[1],"\nsrc_path:",package[2])
-        metrics.append([package[1], metric[0], metric[1]])
+    binaries = schedule_packages(group_by_binary(packages))
+    print_work_units(packages, binaries)
+    if resume and os.path.exists(resume):
+        total = len(binaries)
+        binaries = skip_finished(binaries, read_finished(resume))
+        print(f"Resuming {filename}: {total - len(binaries)} of {total} binaries already done")
+    start = time.perf_counter()
+    done = 0
+    functions = 0
+    failed = 0
 
-    with open(filename, 'w', newline='') as csvfile:
+    total = instrumentation.Stats()
+
+    new_file = not os.path.exists(filename) or os.path.getsize(filename) == 0
+    with open(filename, 'a', newline='') as csvfile, open(filename + ".stats.jsonl", 'a') as statsfile:
         writer = csv.writer(csvfile)
-        writer.writerow(["abspath", "functions", "verified"])
+        if new_file:
+            writer.writerow(["abspath", "srcabspath", "functions", "verified", "error"])
+            csvfile.flush()
+
+        for binary, result, error in run_packages(binaries, jobs, batch_size):
+            if error is not None:
+                failed += 1
+                print("\nbin_path:", binary[1], "\nfailed:", repr(error))
+                for src_path in binary[2]:
+                    writer.writerow([binary[1], src_path, "", "", f"{type(error).__name__}: {error}"])
+            else:
+                metrics, summary = result
+                total.merge(summary)
+                statsfile.write(json.dumps(dict(summary, abspath=binary[1])) + "\n")
+                statsfile.flush()
+                for src_path, (count_functions, verifications, source_error) in zip(binary[2], metrics):
+                    print("\nbin_path:",binary[1],"\nsrc_path:",src_path)
+                    if source_error is not None:
+                        # only this source file failed, --resume retries just this one
+                        print("failed:", repr(source_error))
+                        writer.writerow([binary[1], src_path, "", "", f"{type(source_error).__name__}: {source_error}"])
+                        continue
+                    writer.writerow([binary[1], src_path, count_functions, verifications, ""])
+                    functions += count_functions
+            # every finished binary is on disk, --resume continues after it
+            csvfile.flush()
+            os.fsync(csvfile.fileno())
 
-        for line in metrics:
-            writer.writerow(line)
+            done += 1
+            elapsed = time.perf_counter() - start
+            print(f"[{done}/{len(binaries)}] {functions} functions, {functions / elapsed:.1f} functions/s, {failed} failed")
 
-    csvfile.close()
+    # stage timings of this run, summed over all packages and workers
+    instrumentation.print_summary(total.summary())
+    instrumentation.write_summary(filename + ".stats.json", total.summary(), packages=done - failed)
+    if profiling.directory:
+        # one profile for the whole sweep, merged over all packages and workers
+        profiling.print_merged()
 
     duration = datetime.now()-now
     print("Done! Running took: " + str(duration.total_seconds()))
 
-
 if __name__ == '__main__':
-    main()
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--jobs", type=int, default=1, help="run up to N packages at the same time")
+    arg_parser.add_argument("--dsn", help="archsrc database connection string")
+    arg_parser.add_argument("--db-snapshot", metavar="SQLITE", help="read the archsrc tables from a snapshot made with archsrc_snapshot.py")
+    arg_parser.add_argument("--db-batch", type=int, default=500, help="fetch the functions of N binaries per query, 1 fetches per package")
+    arg_parser.add_argument("--resume", metavar="CSV", help="append to CSV and skip the binaries it already has, failed ones are retried")
+    arg_parser.add_argument("--profile", metavar="DIR", help="write cProfile .pstats and collapsed stacks per package and for the whole run to a new run-<time> directory in DIR")
+    arg_parser.add_argument("--symbol-index", metavar="SQLITE", help="index from symbol_index.py build, functions defined anywhere in it count as verified")
+    arg_parser.add_argument("--cache", help="result cache file (default: $DWARFINFO_CACHE or ~/.cache/dwarfinfo/results.sqlite)")
+    arg_parser.add_argument("--no-cache", action="store_true", help="always verify, do not read or write the result cache")
+    args = arg_parser.parse_args()
+    archsrc_db.configure(args.dsn, new_snapshot=args.db_snapshot)
+    result_cache.configure(args.cache, not args.no_cache)
+    profiling.configure(args.profile)
+    symbol_index.configure(args.symbol_index)
+    main(args.jobs, args.db_batch, args.resume)
@@ -0,0 +1,128 @@
+import mmap
+import os
+from collections import OrderedDict
+
+import instrumentation
+from directives import DirectiveIndex
+
+# rough guess how much memory a parsed tree-sitter tree needs per byte of source
+TREE_BYTES_PER_SOURCE_BYTE = 8
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+# with mmap on, smaller files are still read, every mapping holds a file
+# descriptor, so only the big files are worth one
+MMAP_MIN_BYTES = 1024 * 1024
+# and at most this many mappings stay open at once
+MAX_MAPPED = 64
+
+
+class SourceFile:
+    def __init__(self, path, code, tree, function_names, find_definitions=None):
+        self.path = path
+        self.code = code
+        self.tree = tree
+        self.function_names = function_names
+        self.find_definitions = find_definitions
+        self.definitions = None
+        self.directives = None
+        self.size = len(code) * (1 + TREE_BYTES_PER_SOURCE_BYTE) + sum(len(name) for name in function_names)
+        self.mapped = isinstance(code, mmap.mmap)
+
+    def get_definitions(self):
+        # only built for files where a definition is actually asked for
+        if self.definitions is None:
+            self.definitions = self.find_definitions(self.tree)
+        return self.definitions
+
+    def get_directives(self):
+        # #define and _GL_ index for the regex fallbacks, also built on first use
+        if self.directives is None:
+            with instrumentation.stage("directive_index"):
+                self.directives = DirectiveIndex(self.code)
+        return self.directives
+
+    def close(self):
+        if self.mapped:
+            self.code.close()
+
+
+def read_source(path, use_mmap=False, min_mmap_bytes=MMAP_MIN_BYTES):
+    with open(path, 'rb') as file:
+        if use_mmap and os.fstat(file.fileno()).st_size >= max(min_mmap_bytes, 1):
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return file.read()
+
+
+class SourceCache:
+    # LRU cache for read and parsed source files, keyed by (path, mtime, size)
+    # so that every file is read and parsed only once per run
+    def __init__(self, parser, find_names, find_definitions=None, max_bytes=DEFAULT_MAX_BYTES, use_mmap=False,
+                 min_mmap_bytes=MMAP_MIN_BYTES, max_mapped=MAX_MAPPED):
+        self.parser = parser
+        self.find_names = find_names
+        self.find_definitions = find_definitions
+        self.max_bytes = max_bytes
+        # map the big files instead of reading them, tree-sitter and the
+        # regexes work on the mapping directly
+        self.use_mmap = use_mmap
+        self.min_mmap_bytes = min_mmap_bytes
+        self.max_mapped = max_mapped
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+        self.mapped = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path):
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry
+
+        self.misses += 1
+        entry = self.load(path)
+        self.entries[key] = entry
+        self.current_bytes += entry.size
+        self.mapped += entry.mapped
+        self.evict()
+        return entry
+
+    def load(self, path):
+        # the raw bytes go to tree-sitter as they are, no decoding, so any
+        # source encoding works
+        with instrumentation.stage("read_source"):
+            code = read_source(path, self.use_mmap, self.min_mmap_bytes)
+        instrumentation.count("bytes_read", len(code))
+        with instrumentation.stage("parser.parse"):
+            tree = self.parser.parse(code)
+        with instrumentation.stage("function_names"):
+            function_names = frozenset(self.find_names(tree.root_node))
+        return SourceFile(path, code, tree, function_names, self.find_definitions)
+
+    def evict(self):
+        # always keep the newest entry, even if it alone exceeds the budget
+        while (self.current_bytes > self.max_bytes or self.mapped > self.max_mapped) and len(self.entries) > 1:
+            _, entry = self.entries.popitem(last=False)
+            self.current_bytes -= entry.size
+            self.mapped -= entry.mapped
+            entry.close()
+            self.evictions += 1
+
+    def clear(self):
+        for entry in self.entries.values():
+            entry.close()
+        self.entries.clear()
+        self.current_bytes = 0
+        self.mapped = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.current_bytes,
+        }
@@ -0,0 +1,163 @@
+import argparse
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from tree_sitter import Parser
+
+from source_cache import read_source
+from ts_functions import C_LANGUAGE, function_declarators, function_definitions
+
+SOURCE_SUFFIXES = (".c", ".h")
+
+# index file used for the "defined elsewhere in tree" fallback, None if off
+path = None
+_index = None
+_index_pid = None
+
+_parser = None
+
+
+def configure(new_path=None):
+    global path
+    path = new_path or None
+    close()
+
+
+def get_index():
+    # one read-only connection per process
+    global _index, _index_pid
+    if path is None:
+        return None
+    if _index is None or _index_pid != os.getpid():
+        _index = SymbolIndex(path)
+        _index_pid = os.getpid()
+    return _index
+
+
+def close():
+    global _index, _index_pid
+    if _index is not None and _index_pid == os.getpid():
+        _index.close()
+    _index = None
+    _index_pid = None
+
+
+class SymbolIndex:
+    # function name -> [(file, line, kind)] over a whole source tree,
+    # kind is "definition" or "declaration"
+    def __init__(self, index_path):
+        if not os.path.exists(index_path):
+            raise FileNotFoundError("symbol index %s does not exist, create it with symbol_index.py build" % index_path)
+        self.conn = sqlite3.connect("file:%s?mode=ro" % index_path, uri=True)
+
+    def close(self):
+        self.conn.close()
+
+    def lookup(self, name):
+        return self.conn.execute("SELECT path, line, kind FROM symbols WHERE name = ? ORDER BY kind DESC, path",
+                                 (name,)).fetchall()
+
+    def defined(self, name):
+        return self.conn.execute("SELECT 1 FROM symbols WHERE name = ? AND kind = 'definition' LIMIT 1",
+                                 (name,)).fetchone() is not None
+
+
+def source_files(root):
+    for directory, _, files in os.walk(root):
+        for name in files:
+            if name.endswith(SOURCE_SUFFIXES):
+                yield os.path.abspath(os.path.join(directory, name))
+
+
+def index_file(file_path):
+    # (path, mtime_ns, size, [(name, line, kind), ...]) of one source file,
+    # None if it was deleted since the tree was walked
+    global _parser
+    if _parser is None:
+        _parser = Parser(C_LANGUAGE)
+    try:
+        stat = os.stat(file_path)
+        code = read_source(file_path)
+    except FileNotFoundError:
+        return None
+    tree = _parser.parse(code)
+    definitions = function_definitions(tree)
+    symbols = [(name, definition.start_line, "definition") for name, definition in definitions.items()]
+    defined = set((name, line) for name, line, _ in symbols)
+    symbols.extend((name, line, "declaration") for name, line in set(function_declarators(tree))
+                   if (name, line) not in defined)
+    return file_path, stat.st_mtime_ns, stat.st_size, symbols
+
+
+def build_index(root, index_path, jobs=1):
+    # files that did not change since the last build are not parsed again
+    conn = sqlite3.connect(index_path)
+    conn.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER)")
+    conn.execute("CREATE TABLE IF NOT EXISTS symbols (name TEXT, path TEXT, line INTEGER, kind TEXT)")
+    conn.execute("CREATE INDEX IF NOT EXISTS symbols_name ON symbols (name)")
+    conn.execute("CREATE INDEX IF NOT EXISTS symbols_path ON symbols (path)")
+
+    known = {row[0]: (row[1], row[2]) for row in conn.execute("SELECT path, mtime_ns, size FROM files")}
+    changed = []
+    present = set()
+    for file_path in source_files(root):
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            continue
+        present.add(file_path)
+        if known.get(file_path) != (stat.st_mtime_ns, stat.st_size):
+            changed.append(file_path)
+    # only files below root, /src/foo is not part of /src/foobar
+    prefix = os.path.join(os.path.abspath(root), "")
+    removed = [file_path for file_path in known if file_path not in present and file_path.startswith(prefix)]
+
+    for file_path in removed + changed:
+        conn.execute("DELETE FROM symbols WHERE path = ?", (file_path,))
+        conn.execute("DELETE FROM files WHERE path = ?", (file_path,))
+
+    symbols = 0
+    if jobs > 1:
+        executor = ProcessPoolExecutor(max_workers=jobs)
+        results = executor.map(index_file, changed, chunksize=max(1, len(changed) // (jobs * 8)))
+    else:
+        executor = None
+        results = map(index_file, changed)
+    try:
+        for result in results:
+            if result is None:
+                continue
+            file_path, mtime_ns, size, file_symbols = result
+            conn.execute("INSERT INTO files VALUES (?, ?, ?)", (file_path, mtime_ns, size))
+            conn.executemany("INSERT INTO symbols VALUES (?, ?, ?, ?)",
+                             [(name, file_path, line, kind) for name, line, kind in file_symbols])
+            symbols += len(file_symbols)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    conn.commit()
+    conn.close()
+    return len(present), len(changed), len(removed), symbols
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    commands = arg_parser.add_subparsers(dest="command", required=True)
+    build_parser = commands.add_parser("build", help="index every .c/.h file below a source tree")
+    build_parser.add_argument("src_path")
+    build_parser.add_argument("index")
+    build_parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="parse files in N worker processes")
+    lookup_parser = commands.add_parser("lookup", help="where is a function defined or declared")
+    lookup_parser.add_argument("index")
+    lookup_parser.add_argument("name")
+    args = arg_parser.parse_args()
+    if args.command == "build":
+        start = time.perf_counter()
+        files, parsed, removed, symbols = build_index(args.src_path, args.index, args.jobs)
+        print(f"{files} files, {parsed} parsed, {removed} removed, {symbols} symbols added "
+              f"in {time.perf_counter() - start:.1f}s")
+    else:
+        for file_path, line, kind in SymbolIndex(args.index).lookup(args.name):
+            print(f"{file_path}:{line} {kind}")
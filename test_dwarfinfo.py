@@ -1,16 +1,54 @@
-from unittest import TestCase
-from dwarfinfo import DwarfFunctionInfo, pretty_print, check_if_really_a_function, \
-    check_if_really_a_function_next_line, ts_get_function, tree_sitter_finding_bool
-from mock import patch
+import os
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from unittest import TestCase, skipUnless
+from dwarfinfo import pretty_print, stream_print, check_if_really_a_function, \
+    check_if_really_a_function_next_line, ts_get_function, verify_functions, CFunction, get_srcinfo_parallel
+from dwarf_functions import DwarfFunctionInfo, tree_sitter_finding_bool, parser, find_macro_chain, \
+    macro_alias_cache, get_srcinfo_db, get_srcinfo, iter_srcinfo, iter_subprograms, check_accelerator
+from source_cache import SourceCache
+from directives import DirectiveIndex
+from rename_rules import RenameResolver
+from macro_aliases import MacroAliasCache
+import archsrc_db
+import archsrc_snapshot
+import dwarf_functions
+import dwarfinfo_return
+import result_cache
+import symbol_index
+import run_dwarfinfo
+import instrumentation
+import profiling
+from elftools.elf.elffile import ELFFile
+from psycopg.conninfo import conninfo_to_dict
+from die_scanner import scan_subprograms
+from accel_tables import load_accelerator_index
+from line_tables import LineTableReader
+from ts_functions import function_names_in_tree, function_definitions
+from mock import call, patch
 import re
 
+# tests only touch the result cache they set up themselves
+result_cache.configure(use_cache=False)
+
 
 class Test(TestCase):
-    @patch('dwarfinfo.print_metrics')
-    def test_pretty_print(self, print_metrics_mock):
+    def test_pretty_print(self):
         srcinfo = [DwarfFunctionInfo("main", "testfiles/hello.c", 1, 16)]
         pretty_print(srcinfo, "")
-        print_metrics_mock.assert_called_once_with(1.0, 1, 0)
+        assert srcinfo[0].verification_reason == "definition"
+
+    def test_stream_print(self):
+        cus = [[DwarfFunctionInfo("main", "testfiles/hello.c", 1, 16)],
+               [DwarfFunctionInfo("missing", "testfiles/hello.c", 5, 48)]]
+        extracted = []
+        with patch('builtins.print') as print_mock:
+            stream_print(iter(cus), "", 1, extracted)
+        assert extracted == [("main", "testfiles/hello.c", 1, 16), ("missing", "testfiles/hello.c", 5, 48)]
+        assert call("Not verified:", "missing", 5, "testfiles/hello.c") in print_mock.call_args_list
 
     def test_check_if_really_a_function(self):
         assert check_if_really_a_function("main", "int main() {") == True
@@ -33,9 +71,10 @@ class Test(TestCase):
         assert ts_get_function(code, 'main') == True
 
     def test_ts_get_function_h_prototype(self):
-        # a prototype in a header counts as a function name too
+        # a prototype in a header counts as a function name too, but not as a definition
         with open('testfiles/hello.h') as f: code = f.read()
         assert ts_get_function(code, 'main') == True
+        assert 'main' not in function_definitions(parser.parse(code.encode()))
 
     def test_ts_get_function_with_open(self):
         assert tree_sitter_finding_bool('testfiles/hello_fort.h', 'main') == True
@@ -48,4 +87,517 @@ class Test(TestCase):
         name = "full_write"
         match = re.match(r"# define\s+(\S+)\s+" + name, line)
         print("Match: ", match.group(1))
-        assert match[1] == "full_rw"
\ No newline at end of file
+        assert match[1] == "full_rw"
+
+    def test_source_cache_hit(self):
+        cache = SourceCache(parser, function_names_in_tree)
+        assert 'main' in cache.get('testfiles/hello.c').function_names
+        assert 'main' in cache.get('testfiles/hello.c').function_names
+        assert cache.hits == 1 and cache.misses == 1
+
+    def test_source_cache_eviction(self):
+        cache = SourceCache(parser, function_names_in_tree, max_bytes=1)
+        cache.get('testfiles/hello.c')
+        cache.get('testfiles/hello_rlp.c')
+        assert cache.evictions == 1 and len(cache.entries) == 1
+        assert 'rlp_main' in cache.get('testfiles/hello_rlp.c').function_names
+
+    def test_source_cache_mapped_eviction(self):
+        # small files are read even with mmap on, evicted mappings are closed
+        assert not SourceCache(parser, function_names_in_tree, use_mmap=True).get('testfiles/hello.c').mapped
+        cache = SourceCache(parser, function_names_in_tree, use_mmap=True, min_mmap_bytes=0, max_mapped=1)
+        first = cache.get('testfiles/hello.c')
+        second = cache.get('testfiles/hello_rlp.c')
+        assert first.mapped and first.code.closed and not second.code.closed
+        assert cache.evictions == 1 and cache.mapped == 1
+        cache.clear()
+        assert second.code.closed and cache.mapped == 0
+
+    def test_verify_functions_grouped(self):
+        srcinfo = [DwarfFunctionInfo("main", "testfiles/hello.c", 1, 16),
+                   DwarfFunctionInfo("rlp_main", "testfiles/hello_rlp.c", 1, 32),
+                   DwarfFunctionInfo("missing", "testfiles/hello.c", 5, 48)]
+        files = verify_functions(srcinfo, lambda row: row.path)
+        assert list(files) == ["testfiles/hello.c", "testfiles/hello_rlp.c"]
+        assert [row.verification for row in srcinfo] == [True, True, False]
+
+    def test_cfunction_definitions(self):
+        tree = parser.parse(b"int proto(void);\nchar *dup(const char *s) {\n    return 0;\n}\nint main() {\n    return 0;\n}")
+        definitions = function_definitions(tree)
+        assert sorted(definitions) == ["dup", "main"]
+        assert CFunction(tree, "main", definitions).start_line == 5
+        assert CFunction(tree, "proto", definitions).function_node is None
+
+    def test_find_macro_chain(self):
+        assert find_macro_chain('testfiles/hello_define.c', 'full_write') == ['full_rw', 'xfull_rw', 'other']
+        assert find_macro_chain('testfiles/hello_define.c', 'full_rw') == ['xfull_rw']
+        assert macro_alias_cache.parses == 1
+
+    def test_macro_alias_cache_eviction(self):
+        cache = MacroAliasCache(max_entries=1)
+        cache.get('testfiles/hello_define.c')
+        cache.get('testfiles/hello.c')
+        assert cache.get('testfiles/hello_define.c').alias_chain('full_rw') == ['xfull_rw']
+        assert cache.parses == 3 and cache.evictions == 2 and len(cache.entries) == 1
+
+    def test_verify_functions_parallel(self):
+        srcinfo = [DwarfFunctionInfo("main", "testfiles/hello.c", 1, 16),
+                   DwarfFunctionInfo("rlp_main", "testfiles/hello_rlp.c", 1, 32),
+                   DwarfFunctionInfo("missing", "testfiles/hello.c", 5, 48)]
+        verify_functions(srcinfo, lambda row: row.path, 2)
+        assert [row.verification_reason for row in srcinfo] == ["definition", "definition", None]
+
+    def test_verify_latin1_source(self):
+        fd, path = tempfile.mkstemp(suffix=".c")
+        with os.fdopen(fd, 'wb') as file:
+            file.write("/* Fran\xe7ois */\n#define open_file rpl_open_file\nint open_file(void) {\n    return 0;\n}\n"
+                       "_GL_FUNCDECL (\n    gl_wrapped);\n".encode('latin-1'))
+        try:
+            srcinfo = [DwarfFunctionInfo("open_file", path, 3, 16), DwarfFunctionInfo("rpl_open_file", path, 3, 16),
+                       DwarfFunctionInfo("gl_wrapped", path, 7, 32)]
+            verify_functions(srcinfo, lambda row: row.path)
+            assert [row.verification_reason for row in srcinfo] == ["definition", "defines", "_GL_"]
+            cache = SourceCache(parser, function_names_in_tree, use_mmap=True, min_mmap_bytes=0)
+            assert 'open_file' in cache.get(path).function_names
+        finally:
+            os.remove(path)
+
+    def test_directive_index(self):
+        index = DirectiveIndex(b"#define full_rw full_write\n# define other full_write\n#define wrap(x) impl (x)\n"
+                               b"  #define indented full_write\n_GL_FUNCDECL_RPL (\n    f10, int);\n")
+        assert index.aliases("full_write") == ["full_rw", "other"]
+        assert index.aliases("impl") == ["wrap(x)"]
+        assert "f10" in index.gl_identifiers and "f1" not in index.gl_identifiers
+
+    def test_rename_resolver(self):
+        resolver = RenameResolver()
+        candidates = resolver.candidates("rpl_fopen64")
+        assert candidates["fopen64"] == "prefix:rpl_" and candidates["fopen"] == "prefix:rpl_+suffix:64"
+        # only the leading prefix goes, str.replace used to drop every "m"
+        assert resolver.resolve("memmove", {"emmove", "emove"}) == ("emmove", "prefix:m")
+        assert resolver.resolve("getc_unlocked", {"getc"}) == ("getc", "suffix:_unlocked")
+        assert RenameResolver(["regex:^__(\\w+)_chk$=\\1"]).resolve("__memcpy_chk", {"memcpy"}) == ("memcpy", "regex:^__(\\w+)_chk$=\\1")
+        assert resolver.resolve("main", {"main"}) is None
+        assert resolver.digest() == RenameResolver().digest() != RenameResolver(["prefix:rpl_"]).digest()
+
+    def test_verify_renamed(self):
+        srcinfo = [DwarfFunctionInfo("rpl_full_write", "testfiles/hello_define.c", 5, 16),
+                   DwarfFunctionInfo("full_write64", "testfiles/hello_define.c", 5, 16)]
+        verify_functions(srcinfo, lambda row: row.path)
+        assert [row.verification_reason for row in srcinfo] == ["renamed:prefix:rpl_", "renamed:suffix:64"]
+
+    def test_instrumentation_counters(self):
+        instrumentation.reset()
+        srcinfo = [DwarfFunctionInfo("main", "testfiles/hello.c", 1, 16),
+                   DwarfFunctionInfo("missing", "testfiles/hello.c", 5, 48)]
+        verify_functions(srcinfo, lambda row: row.path)
+        summary = instrumentation.summary()
+        assert summary["counters"]["verification:definition"] == 1
+        assert summary["counters"]["verification:failed"] == 1
+        assert summary["stages"]["verify_file"]["calls"] == 1
+        assert summary["stages"]["defines_extension"]["calls"] == 1
+
+
+class TestResultCache(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        result_cache.configure(os.path.join(self.tmpdir, "results.sqlite"), True)
+
+    def tearDown(self):
+        result_cache.configure(use_cache=False)
+        shutil.rmtree(self.tmpdir)
+
+    def test_srcinfo_round_trip(self):
+        cache = result_cache.get_cache()
+        assert cache.get_srcinfo("build-id:abc") is None
+        cache.put_srcinfo("build-id:abc", [("main", "/src/hello.c", 1, 16)])
+        assert cache.get_srcinfo("build-id:abc") == [("main", "/src/hello.c", 1, 16)]
+        assert cache.hits == 1 and cache.misses == 1
+
+    def test_verification_cached(self):
+        srcinfo = [DwarfFunctionInfo("main", "testfiles/hello.c", 1, 16),
+                   DwarfFunctionInfo("missing", "testfiles/hello.c", 5, 48)]
+        verify_functions(srcinfo, lambda row: row.path)
+        srcinfo = [DwarfFunctionInfo("main", "testfiles/hello.c", 1, 16),
+                   DwarfFunctionInfo("missing", "testfiles/hello.c", 5, 48)]
+        with patch('dwarf_functions.source_cache') as source_cache_mock:
+            verify_functions(srcinfo, lambda row: row.path)
+            source_cache_mock.get.assert_not_called()
+        assert [row.verification_reason for row in srcinfo] == ["definition", None]
+
+    def test_batched_touch(self):
+        cache = result_cache.get_cache()
+        cache.put_verifications("abc", "regex", {"main": "definition"})
+        used = cache.conn.execute("SELECT used FROM verification").fetchone()[0]
+        assert cache.get_verifications("abc", "regex", ["main"]) == {"main": "definition"}
+        assert cache.touched() == 1 and cache.conn.execute("SELECT used FROM verification").fetchone()[0] == used
+        cache.touch()
+        assert cache.touched() == 0 and cache.conn.execute("SELECT used FROM verification").fetchone()[0] > used
+
+    def test_worker_touch_flushed(self):
+        cache = result_cache.get_cache()
+        cache.put_verifications("abc", "regex", {"main": "definition"})
+        cache.conn.execute("UPDATE verification SET used = 0")
+        cache.conn.commit()
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            assert executor.submit(cached_reasons, "abc", "regex", ["main"]).result() == {"main": "definition"}
+        assert cache.conn.execute("SELECT used FROM verification").fetchone()[0] > 0
+
+    def test_source_hash_memoized(self):
+        result_cache._source_hashes.clear()
+        with patch('result_cache.file_hash', return_value="abc") as file_hash_mock:
+            assert result_cache.source_hash('testfiles/hello_define.c') == "abc"
+            assert result_cache.source_hash('testfiles/hello_define.c') == "abc"
+        assert file_hash_mock.call_count == 1
+
+    def test_eviction(self):
+        cache = result_cache.ResultCache(os.path.join(self.tmpdir, "small.sqlite"), 64 * 1024)
+        for i in range(200):
+            cache.put_srcinfo("sha256:%d" % i, [("f%d_%d" % (i, j), "/src/%d.c" % j, j, j) for j in range(50)])
+        assert cache.size() <= 64 * 1024
+        assert cache.get_srcinfo("sha256:199") is not None and cache.get_srcinfo("sha256:0") is None
+        cache.close()
+
+
+def cached_reasons(source_hash, mode, names):
+    # only marks the row as used, the write is left to the worker's exit
+    return result_cache.get_cache().get_verifications(source_hash, mode, names)
+
+
+class TestProfiling(TestCase):
+
+    def test_collapsed_stacks(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            profiling.configure(tmpdir)
+            srcinfo = [DwarfFunctionInfo("main", "testfiles/hello.c", 1, 16)]
+            profiling.run("verify", verify_functions, srcinfo, lambda row: row.path)
+            profiling.merge()
+            with open(os.path.join(profiling.directory, "aggregate.collapsed")) as file:
+                stacks = [line.rsplit(" ", 1)[0] for line in file]
+            assert any(stack.startswith("verify_functions (dwarfinfo.py:") and ";verify_file (dwarf_functions.py:" in stack
+                       for stack in stacks)
+            assert os.path.exists(os.path.join(profiling.directory, "verify.pstats"))
+        finally:
+            profiling.configure(None)
+            shutil.rmtree(tmpdir)
+
+    def test_worker_profiles(self):
+        # one profile per worker process, in a directory of its own per run
+        tmpdir = tempfile.mkdtemp()
+        try:
+            profiling.configure(tmpdir)
+            first_run = profiling.directory
+            srcinfo = [DwarfFunctionInfo("main", "testfiles/hello.c", 1, 16),
+                       DwarfFunctionInfo("rlp_main", "testfiles/hello_rlp.c", 1, 16)]
+            verify_functions(srcinfo, lambda row: row.path, jobs=2)
+            worker_profiles = [name for name in os.listdir(first_run) if name.startswith("worker-")]
+            assert 1 <= len(worker_profiles) <= 2
+            profiling.configure(tmpdir)
+            assert profiling.directory != first_run and os.listdir(profiling.directory) == []
+            with patch('builtins.print') as print_mock:
+                profiling.print_merged()
+            print_mock.assert_called_once_with("No profiles in", profiling.directory)
+            profiling.run("verify", verify_functions, srcinfo, lambda row: row.path)
+            assert profiling.merge() == os.path.join(profiling.directory, "aggregate")
+            assert sorted(os.listdir(profiling.directory)) == ["aggregate.collapsed", "aggregate.pstats",
+                                                               "verify.collapsed", "verify.pstats"]
+        finally:
+            profiling.configure(None)
+            shutil.rmtree(tmpdir)
+
+
+class TestSymbolIndex(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.index = os.path.join(self.tmpdir, "symbols.sqlite")
+
+    def tearDown(self):
+        symbol_index.configure(None)
+        shutil.rmtree(self.tmpdir)
+
+    def test_build_and_lookup(self):
+        files, parsed, _, _ = symbol_index.build_index("testfiles", self.index, 2)
+        assert files == parsed == 6
+        index = symbol_index.SymbolIndex(self.index)
+        assert (os.path.abspath("testfiles/hello_define.c"), 5, "definition") in index.lookup("full_write")
+        assert not index.defined("missing")
+        index.close()
+        # unchanged files are not parsed again
+        assert symbol_index.build_index("testfiles", self.index)[1] == 0
+
+    def test_sibling_tree_and_deleted_file(self):
+        for directory in ("src", "srcx"):
+            os.mkdir(os.path.join(self.tmpdir, directory))
+            with open(os.path.join(self.tmpdir, directory, "f.c"), 'w') as file:
+                file.write("int f_%s(void) { return 0; }\n" % directory)
+        symbol_index.build_index(os.path.join(self.tmpdir, "srcx"), self.index)
+        # the files of srcx are not below src, although their path starts with it
+        assert symbol_index.build_index(os.path.join(self.tmpdir, "src"), self.index)[2] == 0
+        index = symbol_index.SymbolIndex(self.index)
+        assert index.defined("f_src") and index.defined("f_srcx")
+        index.close()
+        assert symbol_index.index_file(os.path.join(self.tmpdir, "gone.c")) is None
+
+    def test_verify_elsewhere(self):
+        symbol_index.build_index("testfiles", self.index)
+        symbol_index.configure(self.index)
+        srcinfo = [DwarfFunctionInfo("full_write", "/nonexistent/hello_define.c", 5, 16),
+                   DwarfFunctionInfo("main", "testfiles/hello_rlp.c", 1, 32),
+                   DwarfFunctionInfo("missing", "/nonexistent/hello.c", 1, 48)]
+        verify_functions(srcinfo, lambda row: row.path)
+        assert [row.verification_reason for row in srcinfo] == ["elsewhere", "elsewhere", None]
+
+
+class TestResume(TestCase):
+
+    def test_skip_finished(self):
+        fd, filename = tempfile.mkstemp(suffix=".csv")
+        with os.fdopen(fd, 'w') as csvfile:
+            csvfile.write("abspath,srcabspath,functions,verified,error\r\n"
+                          "/bin/a,/src/a.c,3,2,\r\n"
+                          "/bin/b,/src/b.c,,,OSError: gone\r\n"
+                          "/bin/c,/src/c1.c,5,5,\r\n"
+                          "/bin/c,/src/c2.c,4")
+        try:
+            finished = run_dwarfinfo.read_finished(filename)
+            with open(filename) as csvfile:
+                assert csvfile.read().endswith("/src/c1.c,5,5,\n")
+        finally:
+            os.remove(filename)
+        binaries = [["a", "/bin/a", ["/src/a.c"], 3], ["b", "/bin/b", ["/src/b.c"], 1],
+                    ["c", "/bin/c", ["/src/c1.c", "/src/c2.c"], 9]]
+        assert run_dwarfinfo.skip_finished(binaries, finished) == [["b", "/bin/b", ["/src/b.c"], 1],
+                                                                   ["c", "/bin/c", ["/src/c2.c"], 9]]
+
+    def test_group_by_binary(self):
+        packages = [("p", "/bin/a", "/src/b.c", 2), ("p", "/bin/a", "/src/a.c", 1), ("q", "/bin/q", "/src/q.c", 4),
+                    ("p", "/bin/a", "/src/b.c", 3)]
+        assert run_dwarfinfo.group_by_binary(packages) == [["p", "/bin/a", ["/src/b.c", "/src/a.c"], 6],
+                                                           ["q", "/bin/q", ["/src/q.c"], 4]]
+
+    def test_failing_source(self):
+        # the other source files of the binary are still verified
+        error = OSError("gone")
+        srcinfo = [DwarfFunctionInfo("main", "/src/a.c", 1, 16)]
+        with patch('dwarfinfo_return.pretty_print', side_effect=[[1, 1], error, [1, 0]]):
+            metrics = dwarfinfo_return.main_sources("/bin/a", ["/src/a.c", "/src/b.c", "/src/c.c"], True, "", srcinfo)
+        assert metrics == [[1, 1, None], [0, 0, error], [1, 0, None]]
+
+    def test_lib_path_loaded_once(self):
+        # libclang is already loaded in a forked worker, a second set_library_file would raise
+        with patch('clang.cindex.Config.loaded', True), \
+                patch('clang.cindex.Config.set_library_file') as set_library_file_mock:
+            try:
+                dwarfinfo_return.main_sources("/bin/a", [], True, "/usr/lib/libclang.so", [])
+                assert dwarf_functions.LIBPATH == "/usr/lib/libclang.so"
+            finally:
+                dwarf_functions.LIBPATH = None
+        set_library_file_mock.assert_not_called()
+
+    def test_worker_crash(self):
+        # the workers are forked, so they run the patched run_package too
+        binaries = [["p", name, ["/src/%s.c" % name], 1] for name in ("a", "crash", "b", "c", "d", "e")]
+        with patch('run_dwarfinfo.run_package', crash_package), \
+                patch('run_dwarfinfo.prefetch_srcinfo', lambda binaries, batch_size: ((b, None) for b in binaries)):
+            results = {binary[1]: (result, error) for binary, result, error in run_dwarfinfo.run_packages(binaries, 2)}
+        assert sorted(results) == ["a", "b", "c", "crash", "d", "e"]
+        assert isinstance(results["crash"][1], run_dwarfinfo.BrokenProcessPool)
+        assert all(results[name] == (([[1, 1, None]], {}), None) for name in "abcde")
+
+
+def crash_package(binary, srcinfo=None):
+    if binary[1] == "crash":
+        os._exit(1)
+    return [[1, 1, None]], {}
+
+
+class TestArchsrcSnapshot(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        path = os.path.join(self.tmpdir, "archsrc.sqlite")
+        snapshot = sqlite3.connect(path)
+        snapshot.executescript(archsrc_snapshot.SCHEMA + archsrc_snapshot.INDEXES)
+        snapshot.execute("INSERT INTO binaries VALUES (1, 'hello', '/pkg/usr/bin/hello', 'usr/bin/hello', '00000')")
+        snapshot.executemany("INSERT INTO binary_functions VALUES (?, ?, ?, ?, ?)",
+                             [(1, '["main"]', '/usr/src/hello.c', 1, 16), (1, '["ext"]', None, 0, 48)])
+        snapshot.commit()
+        snapshot.close()
+        archsrc_db.configure(new_snapshot=path)
+
+    def tearDown(self):
+        archsrc_db.configure(new_snapshot="")
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_srcinfo_db(self):
+        srcinfo = get_srcinfo_db("bin/hello")
+        assert [(row.name, row.path, row.line) for row in srcinfo] == [("main", "/usr/src/hello.c", 1)]
+
+    def test_batch_and_package_units(self):
+        srcinfo = dwarfinfo_return.get_srcinfo_db_batch(["bin/hello", "bin/missing"])
+        assert [row.name for row in srcinfo["bin/hello"]] == ["main"] and srcinfo["bin/missing"] == []
+        assert archsrc_db.fetch_package_units(100) == [("hello", "/pkg/usr/bin/hello", "/usr/src/hello.c", 1)]
+
+
+class TestArchsrcDsn(TestCase):
+
+    def test_default_dsn(self):
+        # an empty password has to be quoted or it swallows the next keyword
+        dsn = conninfo_to_dict(archsrc_db.DEFAULT_DSN)
+        assert dsn['host'] == 'kuria' and dsn['password'] == ''
+
+
+# needs a scratch PostgreSQL database, e.g. ARCHSRC_TEST_DSN="dbname=archsrc_test host=localhost"
+@skipUnless(os.environ.get("ARCHSRC_TEST_DSN"), "ARCHSRC_TEST_DSN not set")
+class TestArchsrcDb(TestCase):
+
+    def setUp(self):
+        archsrc_db.configure(os.environ["ARCHSRC_TEST_DSN"])
+        with archsrc_db.get_pool().connection() as conn:
+            conn.execute("DROP TABLE IF EXISTS binary_functions, binaries")
+            conn.execute("CREATE TABLE binaries (binary_id int, pkg text, abspath text, relpath text, compileopt text)")
+            conn.execute("CREATE TABLE binary_functions (binary_id int, name text[], srcabspath text, srcline int, vaddr bigint)")
+            conn.execute("INSERT INTO binaries VALUES (1, 'hello', '/pkg/usr/bin/hello', 'usr/bin/hello', '00000'),"
+                         " (2, 'rlp', '/pkg/usr/bin/rlp', 'usr/bin/rlp', '00000')")
+            conn.execute("INSERT INTO binary_functions VALUES (1, '{main}', '/usr/src/hello.c', 1, 16),"
+                         " (1, '{helper}', '/usr/src/hello.c', 5, 32), (1, '{ext}', NULL, 0, 48),"
+                         " (2, '{rlp_main}', '/usr/src/hello_rlp.c', 1, 16)")
+
+    def tearDown(self):
+        archsrc_db.close()
+
+    def test_get_srcinfo_db(self):
+        srcinfo = get_srcinfo_db("bin/hello")
+        assert [(row.name, row.path, row.line) for row in srcinfo] == [("main", "/usr/src/hello.c", 1),
+                                                                      ("helper", "/usr/src/hello.c", 5)]
+
+    def test_get_srcinfo_db_batch(self):
+        srcinfo = dwarfinfo_return.get_srcinfo_db_batch(["bin/hello", "bin/rlp", "bin/missing"])
+        assert [row.name for row in srcinfo["bin/rlp"]] == ["rlp_main"]
+        assert len(srcinfo["bin/hello"]) == 2 and srcinfo["bin/missing"] == []
+
+    def test_fetch_package_units(self):
+        rows = archsrc_db.fetch_package_units(100)
+        assert sorted(rows) == [("hello", "/pkg/usr/bin/hello", "/usr/src/hello.c", 2),
+                                ("rlp", "/pkg/usr/bin/rlp", "/usr/src/hello_rlp.c", 1)]
+
+    def test_snapshot_round_trip(self):
+        tmpdir = tempfile.mkdtemp()
+        snapshot = os.path.join(tmpdir, "archsrc.sqlite")
+        try:
+            archsrc_snapshot.export_snapshot(snapshot, ["hello"])
+            expected = archsrc_db.fetch_functions("usr/bin/hello")
+            with archsrc_db.get_pool().connection() as conn:
+                conn.execute("DELETE FROM binary_functions")
+                conn.execute("DELETE FROM binaries")
+            archsrc_snapshot.import_snapshot(snapshot)
+            assert sorted(archsrc_db.fetch_functions("usr/bin/hello")) == sorted(expected)
+            assert archsrc_db.fetch_functions("usr/bin/rlp") == []
+            archsrc_db.configure(new_snapshot=snapshot)
+            assert sorted(archsrc_db.fetch_functions("usr/bin/hello")) == sorted(expected)
+        finally:
+            archsrc_db.configure(new_snapshot="")
+            shutil.rmtree(tmpdir)
+
+
+@skipUnless(shutil.which("gcc"), "gcc not installed")
+class TestDwarf(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.binary = os.path.join(cls.tmpdir, "hello")
+        subprocess.run(["gcc", "-g", "-O0", "-o", cls.binary, os.path.abspath("testfiles/hello.c"),
+                        os.path.abspath("testfiles/hello_define.c")], check=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def srcinfo(self, get):
+        with open(self.binary, 'rb') as fo:
+            return [(row.name, os.path.basename(row.path), row.line) for row in get(ELFFile(fo).get_dwarf_info())]
+
+    def test_get_srcinfo(self):
+        assert self.srcinfo(get_srcinfo) == [("main", "hello.c", 1), ("full_write", "hello_define.c", 5)]
+
+    def test_iter_srcinfo(self):
+        with open(self.binary, 'rb') as fo:
+            batches = list(iter_srcinfo(ELFFile(fo).get_dwarf_info()))
+        assert [[row.name for row in functions] for functions in batches] == [["main"], ["full_write"]]
+
+    def test_get_srcinfo_parallel(self):
+        instrumentation.reset()
+        rows = get_srcinfo_parallel(self.binary, 2)
+        # the stages timed in the decode workers come back to the parent, one call per CU
+        assert instrumentation.summary()["stages"]["get_srcinfo"]["calls"] == 2
+        # the forked workers use the parent's DWARF sections instead of reading their own
+        assert "load_dwarf" not in instrumentation.summary()["stages"]
+        assert [(row.name, os.path.basename(row.path), row.line) for row in rows] == self.srcinfo(get_srcinfo)
+
+    def test_scan_subprograms(self):
+        with open(self.binary, 'rb') as fo:
+            dwarf = ELFFile(fo).get_dwarf_info()
+            for CU in dwarf.iter_CUs():
+                assert scan_subprograms(dwarf, CU) == list(iter_subprograms(CU))
+
+    def test_scan_nested_function(self):
+        # a GNU C nested function inside a block is a subprogram in a lexical block
+        source = os.path.join(self.tmpdir, "nested.c")
+        binary = os.path.join(self.tmpdir, "nested")
+        with open(source, 'w') as file:
+            file.write("int main(int argc, char **argv) {\n    if (argc) {\n        int inner(int x) { return x + argc; }\n"
+                       "        return inner(1);\n    }\n    return 0;\n}\n")
+        subprocess.run(["gcc", "-g", "-O0", "-o", binary, source], check=True)
+        with open(binary, 'rb') as fo:
+            dwarf = ELFFile(fo).get_dwarf_info()
+            for CU in dwarf.iter_CUs():
+                records = scan_subprograms(dwarf, CU)
+                assert records == list(iter_subprograms(CU))
+                assert "inner" in [record[0] for record in records]
+
+    def test_debug_names(self):
+        # gcc does not write .debug_names, so build a minimal one for the test binary
+        with open(self.binary, 'rb') as fo:
+            dwarf = ELFFile(fo).get_dwarf_info()
+            entries = [(cu_index, DIE.offset - CU.cu_offset) for cu_index, CU in enumerate(dwarf.iter_CUs())
+                       for DIE in CU.iter_DIEs() if DIE.tag == 'DW_TAG_subprogram']
+            cu_offsets = [CU.cu_offset for CU in dwarf.iter_CUs()]
+        abbrevs = bytes([1, 0x2e, 1, 0x0b, 3, 0x13, 0, 0, 0])
+        pool = b"".join(bytes([1, cu_index]) + offset.to_bytes(4, 'little') + b"\0" for cu_index, offset in entries)
+        body = (b"\5\0\0\0" + b"".join(count.to_bytes(4, 'little') for count in
+                                        [len(cu_offsets), 0, 0, 0, len(entries), len(abbrevs), 0])
+                + b"".join(offset.to_bytes(4, 'little') for offset in cu_offsets)
+                + bytes(4 * len(entries))
+                + b"".join((i * 7).to_bytes(4, 'little') for i in range(len(entries)))
+                + abbrevs + pool)
+        section = os.path.join(self.tmpdir, "debug_names")
+        with open(section, 'wb') as file:
+            file.write(len(body).to_bytes(4, 'little') + body)
+        binary = os.path.join(self.tmpdir, "hello_names")
+        subprocess.run(["objcopy", "--add-section", ".debug_names=" + section, self.binary, binary], check=True)
+
+        with open(binary, 'rb') as fo:
+            elffile = ELFFile(fo)
+            accel = load_accelerator_index(elffile)
+            assert sorted(accel) == cu_offsets and all(accel.values())
+            srcinfo, same = check_accelerator(elffile.get_dwarf_info(), accel)
+            assert same and [row.name for row in srcinfo] == ["main", "full_write"]
+
+    def test_line_tables(self):
+        binary = os.path.join(self.tmpdir, "hello_dwarf4")
+        subprocess.run(["gcc", "-gdwarf-4", "-O0", "-o", binary, os.path.abspath("testfiles/hello.c"),
+                        os.path.abspath("testfiles/hello_define.c")], check=True)
+        for path in (self.binary, binary):
+            with open(path, 'rb') as fo:
+                dwarf = ELFFile(fo).get_dwarf_info()
+                reader = LineTableReader(dwarf)
+                for CU in dwarf.iter_CUs():
+                    top_DIE = CU.get_top_DIE()
+                    comp_dir = top_DIE.attributes['DW_AT_comp_dir'].value.decode('latin-1')
+                    paths = reader.read_file_paths(top_DIE.attributes['DW_AT_stmt_list'].value, comp_dir)
+                    assert paths == reader.lineprog_file_paths(CU, comp_dir)
+                assert [os.path.basename(row.path) for row in get_srcinfo(dwarf)] == ["hello.c", "hello_define.c"]
@@ -0,0 +1,63 @@
+from tree_sitter import Language
+import tree_sitter_c as ts_c
+
+C_LANGUAGE = Language(ts_c.language())
+
+# compiled once per process, matches the same identifiers find_function_names
+# collects: the declarator name of every function_declarator
+FUNCTION_NAMES_QUERY = C_LANGUAGE.query("""
+(function_declarator
+    declarator: (identifier) @function_name
+)
+""")
+
+
+def function_names_in_tree(node):
+    captures = FUNCTION_NAMES_QUERY.captures(node)
+    return frozenset(capture.text.decode('utf-8', 'replace') for capture in captures.get('function_name', []))
+
+
+# FUNCTION_QUERY without the name predicate, so it is compiled once and
+# answers every function of a tree in a single run
+FUNCTION_DEFINITIONS_QUERY = C_LANGUAGE.query("""
+(function_definition
+    declarator: (function_declarator
+        declarator: (identifier) @function_name
+    )
+    body: (compound_statement) @function.body
+)
+(function_definition
+    declarator: (pointer_declarator
+        declarator: (function_declarator
+            declarator: (identifier) @function_name
+        )
+    )
+    body: (compound_statement) @function.body
+)
+""")
+
+
+class FunctionDefinition:
+    def __init__(self, name, node, body):
+        self.name = name
+        self.node = node
+        self.body_range = (body.start_byte, body.end_byte)
+        # tree-sitter rows start at 0, DW_AT_decl_line at 1
+        self.start_line = node.start_point[0] + 1
+
+
+def function_definitions(tree):
+    definitions = {}
+    for _, captures in FUNCTION_DEFINITIONS_QUERY.matches(tree.root_node):
+        node = captures['function_name'][0]
+        name = node.text.decode('utf-8', 'replace')
+        # keep the first one if a name is defined several times (#ifdef branches)
+        if name not in definitions:
+            definitions[name] = FunctionDefinition(name, node, captures['function.body'][0])
+    return definitions
+
+
+def function_declarators(tree):
+    # (name, 1-based line) of every function_declarator, definitions included
+    return [(node.text.decode('utf-8', 'replace'), node.start_point[0] + 1)
+            for node in FUNCTION_NAMES_QUERY.captures(tree.root_node).get('function_name', [])]